@@ -1,6 +1,7 @@
 import argparse
 import json
 import os.path as op
+import sys
 from glob import glob
 
 import matplotlib.pyplot as plt
@@ -10,6 +11,9 @@ import seaborn as sns
 from kneed import KneeLocator
 from numpy import mean
 
+sys.path.append("/home/data/abcd/code/abcd_fmriprep-analysis")
+from utils import OutlierRegistry
+
 
 def _get_parser():
     parser = argparse.ArgumentParser(description="Perform QCFC analyses")
@@ -137,12 +141,8 @@ def main(
             ]
         )
 
-    runs_to_exclude_df = pd.read_csv(op.join(mriqc_dir, "runs_to_exclude.tsv"), sep="\t")
-    runs_to_exclude = runs_to_exclude_df["bids_name"].tolist()
-    prefixes_tpl = tuple(runs_to_exclude)
-    confounds_clean_files = [
-        x for x in confounds_files if not op.basename(x).startswith(prefixes_tpl)
-    ]
+    registry = OutlierRegistry(op.join(mriqc_dir, "runs_to_exclude.tsv"))
+    confounds_clean_files = registry.filter(confounds_files)
 
     kn_CSF_lst = []
     kn_WM_lst = []
@@ -0,0 +1,157 @@
+import argparse
+import os
+import os.path as op
+import sys
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+sys.path.append("/code")
+from denoising import nuisance_reg
+from utils import run_tool
+
+# Denoising variants: name, band pass, smoothing
+VARIANTS = [
+    ("unfiltered", False, False),
+    ("filtered", True, False),
+    ("smoothed", True, True),
+]
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        description="Compare the in-process nuisance regression with 3dTproject on one run"
+    )
+    parser.add_argument(
+        "--preproc_file",
+        dest="preproc_file",
+        required=True,
+        help="fMRIPrep preprocessed BOLD run",
+    )
+    parser.add_argument(
+        "--mask_file",
+        dest="mask_file",
+        required=True,
+        help="Brain mask of the run",
+    )
+    parser.add_argument(
+        "--regressor_file",
+        dest="regressor_file",
+        required=True,
+        help="Regressors of the run written by denoising.py (*_regressors.1D)",
+    )
+    parser.add_argument(
+        "--dummy_scans",
+        dest="dummy_scans",
+        required=True,
+        type=int,
+        help="Dummy scans removed from the run",
+    )
+    parser.add_argument(
+        "--out_dir",
+        dest="out_dir",
+        required=True,
+        help="Directory for the denoised runs of both implementations",
+    )
+    parser.add_argument(
+        "--tol",
+        dest="tol",
+        default=1e-3,
+        type=float,
+        required=False,
+        help="Largest relative RMS difference of each variant",
+    )
+    return parser
+
+
+def tproject(preproc_file, dummy_scans, out_file, regressor_file, mask_file, band_pass, smooth):
+    """Denoise a run with the 3dTproject call that nuisance_reg replaced."""
+    args = [
+        "3dTproject",
+        "-input",
+        f"{preproc_file}[{dummy_scans}..$]",
+        "-polort",
+        "1",
+        "-prefix",
+        out_file,
+        "-ort",
+        regressor_file,
+        "-mask",
+        mask_file,
+    ]
+    if smooth:
+        args += ["-blur", "6"]
+    if band_pass:
+        args += ["-passband", "0.01", "0.10"]
+    run_tool(args)
+
+
+def relative_rms(reference, data):
+    return np.sqrt(np.sum(np.square(data - reference)) / np.sum(np.square(reference)))
+
+
+def main(preproc_file, mask_file, regressor_file, dummy_scans, out_dir, tol):
+    """Check nuisance_reg against 3dTproject on the unfiltered, filtered and smoothed variants.
+
+    For each variant, the maximum and mean absolute differences and the
+    relative RMS difference over the mask are printed and written to
+    check_nuisance_reg.tsv in out_dir. The check fails when a relative RMS
+    difference is above tol.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    afni_files = {name: op.join(out_dir, f"afni_{name}_bold.nii.gz") for name, _, _ in VARIANTS}
+    numpy_files = {name: op.join(out_dir, f"numpy_{name}_bold.nii.gz") for name, _, _ in VARIANTS}
+    for name, band_pass, smooth in VARIANTS:
+        if not op.exists(afni_files[name]):
+            tproject(
+                preproc_file,
+                dummy_scans,
+                afni_files[name],
+                regressor_file,
+                mask_file,
+                band_pass,
+                smooth,
+            )
+    nuisance_reg(
+        preproc_file,
+        dummy_scans,
+        regressor_file,
+        mask_file,
+        [
+            {"file": numpy_files[name], "band_pass": band_pass, "smooth": smooth, "censor": None}
+            for name, band_pass, smooth in VARIANTS
+        ],
+    )
+
+    mask = np.asanyarray(nib.load(mask_file).dataobj) > 0
+    results = []
+    for name, _, _ in VARIANTS:
+        reference = nib.load(afni_files[name]).get_fdata(dtype=np.float32)[mask]
+        data = nib.load(numpy_files[name]).get_fdata(dtype=np.float32)[mask]
+        abs_diff = np.abs(data - reference)
+        results.append(
+            {
+                "variant": name,
+                "max_abs_diff": abs_diff.max(),
+                "mean_abs_diff": abs_diff.mean(),
+                "relative_rms": relative_rms(reference, data),
+            }
+        )
+    results_df = pd.DataFrame(results)
+    results_df["passed"] = results_df["relative_rms"] <= tol
+    results_df.to_csv(op.join(out_dir, "check_nuisance_reg.tsv"), sep="\t", index=False)
+    print(results_df.to_string(index=False), flush=True)
+
+    if not results_df["passed"].all():
+        sys.exit(1)
+
+
+def _main(argv=None):
+    option = _get_parser().parse_args(argv)
+    kwargs = vars(option)
+    main(**kwargs)
+
+
+if __name__ == "__main__":
+    _main()
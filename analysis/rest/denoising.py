@@ -3,14 +3,33 @@ import json
 import os
 import os.path as op
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 from glob import glob
-from shutil import copyfile
+from shutil import copy2
 
 import numpy as np
 import pandas as pd
 
 sys.path.append("/code")
-from utils import enhance_censoring, fd_censoring, get_nvol, run_command
+from utils import (
+    Confounds,
+    OutlierRegistry,
+    StageTimer,
+    Workflow,
+    enhance_censoring,
+    fd_censoring,
+    get_nvol,
+    manufacturer_dummy_scans,
+    run_subjects,
+    run_tool,
+    select_subjects,
+    set_command_log,
+    set_command_timeout,
+    set_threads,
+    split_cores,
+    tool_versions,
+)
 
 
 def _get_parser():
@@ -34,10 +53,36 @@ def _get_parser():
         help="Path to denoising directory",
     )
     parser.add_argument(
+        "--subjects",
         "--subject",
-        dest="subject",
-        required=True,
-        help="Subject identifier, with the sub- prefix.",
+        dest="subjects",
+        default=None,
+        required=False,
+        nargs="+",
+        help="Subject identifiers, with the sub- prefix.",
+    )
+    parser.add_argument(
+        "--participants_file",
+        dest="participants_file",
+        default=None,
+        required=False,
+        help="Path to participants.tsv, to select subjects by row and get dummy scans",
+    )
+    parser.add_argument(
+        "--start",
+        dest="start",
+        default=None,
+        type=int,
+        required=False,
+        help="First participants_file row (0-based) to process, without --subjects",
+    )
+    parser.add_argument(
+        "--stop",
+        dest="stop",
+        default=None,
+        type=int,
+        required=False,
+        help="Row after the last participants_file row to process, without --subjects",
     )
     parser.add_argument(
         "--sessions",
@@ -64,8 +109,9 @@ def _get_parser():
     parser.add_argument(
         "--dummy_scans",
         dest="dummy_scans",
-        required=True,
-        help="Dummy Scans",
+        default=None,
+        required=False,
+        help="Dummy Scans. Default: from the Manufacturer column of participants_file",
     )
     parser.add_argument(
         "--desc_list",
@@ -81,221 +127,321 @@ def _get_parser():
         required=False,
         help="CPUs",
     )
+    parser.add_argument(
+        "--run_index",
+        dest="run_index",
+        default=None,
+        required=False,
+        help="Run index (see run_index.py) to read the run metadata from, instead of headers",
+    )
+    parser.add_argument(
+        "--scratch_ext",
+        dest="scratch_ext",
+        default=".nii.gz",
+        choices=[".nii.gz", ".nii"],
+        required=False,
+        help="Extension of the intermediate images. .nii (uncompressed) is faster on scratch",
+    )
+    parser.add_argument(
+        "--n_workers",
+        dest="n_workers",
+        default=1,
+        type=int,
+        required=False,
+        help="Subjects processed in parallel",
+    )
+    parser.add_argument(
+        "--timeout",
+        dest="timeout",
+        default=None,
+        type=float,
+        required=False,
+        help="Seconds after which an AFNI tool is killed. Default: 12 hours",
+    )
     return parser
 
 
-def get_motionpar(confounds_file, derivatives=None):
-    confounds_df = pd.read_csv(confounds_file, sep="\t")
-    if derivatives:
-        motion_labels = [
-            "trans_x",
-            "trans_x_derivative1",
-            "trans_y",
-            "trans_y_derivative1",
-            "trans_z",
-            "trans_z_derivative1",
-            "rot_x",
-            "rot_x_derivative1",
-            "rot_y",
-            "rot_y_derivative1",
-            "rot_z",
-            "rot_z_derivative1",
-        ]
-    else:
-        motion_labels = ["trans_x", "trans_y", "trans_z", "rot_x", "rot_y", "rot_z"]
-    motion_regressors = confounds_df[motion_labels].values
-    return motion_regressors
-
+def add_outlier(mriqc_dir, prefix):
+    registry = OutlierRegistry(op.join(mriqc_dir, "runs_to_exclude.tsv"))
+    if not registry.add(prefix):
+        print(f"\t\t\t{prefix} already in runs_to_exclude.tsv")
 
-# Taken from Cody's pipeline
-def get_acompcor(confounds_file):
-    print("\t\tGet aCompCor")
-    confounds_json_file = confounds_file.replace(".tsv", ".json")
-    confounds_df = pd.read_csv(confounds_file, sep="\t")
-    with open(confounds_json_file) as json_file:
-        data = json.load(json_file)
-    w_comp_cor = sorted([x for x in data.keys() if "w_comp_cor" in x])
-    c_comp_cor = sorted([x for x in data.keys() if "c_comp_cor" in x])
-    
-    # From Muschelli 2014
-    acompcor_list_CSF = [x for x in c_comp_cor if data[x]["Mask"] == "CSF"]
-    acompcor_list_CSF = acompcor_list_CSF[0:5]
-    acompcor_list_WM = [x for x in w_comp_cor if data[x]["Mask"] == "WM"]
-    acompcor_list_WM = acompcor_list_WM[0:5]
-    acompcor_list = []
-    acompcor_list.extend(acompcor_list_CSF)
-    acompcor_list.extend(acompcor_list_WM)
 
-    print(f"\t\t\tComponents: {acompcor_list}", flush=True)
-    acompcor_arr = confounds_df[acompcor_list].values
+def legendre_polort(n_vols, polort):
+    """Legendre polynomials up to order polort, as in AFNI's -polort."""
+    return np.polynomial.legendre.legvander(np.linspace(-1, 1, n_vols), polort)
 
-    return acompcor_arr
 
+def stopband_regressors(n_vols, t_r, passband):
+    """Sine and cosine regressors for the frequencies outside passband.
 
-def get_gsr(confounds_file):
-    confounds_df = pd.read_csv(confounds_file, sep="\t")
+    Matches 3dTproject -passband: every Fourier frequency k / (n_vols * t_r),
+    k = 1..n_vols/2, below passband[0] or above passband[1] is projected out
+    (the Nyquist frequency only has a cosine term).
+    """
+    frames = np.arange(n_vols)
+    stopband = []
+    for k in range(1, n_vols // 2 + 1):
+        freq = k / (n_vols * t_r)
+        if passband[0] <= freq <= passband[1]:
+            continue
+        stopband.append(np.cos(2 * np.pi * k * frames / n_vols))
+        if 2 * k != n_vols:
+            stopband.append(np.sin(2 * np.pi * k * frames / n_vols))
+    if len(stopband) == 0:
+        return np.zeros((n_vols, 0))
+    return np.column_stack(stopband)
 
-    gsr_regressor = confounds_df["global_signal"].values
-    return gsr_regressor
 
+def projection_basis(design):
+    """Orthonormal basis of the column space of the design matrix."""
+    u, s, _ = np.linalg.svd(design, full_matrices=False)
+    rank = np.sum(s > s.max() * max(design.shape) * np.finfo(s.dtype).eps)
+    return u[:, :rank]
 
-def add_outlier(mriqc_dir, prefix):
-    runs_to_exclude_df = pd.read_csv(op.join(mriqc_dir, "runs_to_exclude.tsv"), sep="\t")
-    runs_to_exclude = runs_to_exclude_df["bids_name"].tolist()
 
-    if prefix in runs_to_exclude:
-        print(f"\t\t\t{prefix} already in runs_to_exclude.tsv")
-    else:
-        runs_to_exclude.append(prefix)
-        new_runs_to_exclude_df = pd.DataFrame()
-        new_runs_to_exclude_df["bids_name"] = runs_to_exclude
-        new_runs_to_exclude_df.to_csv(
-            op.join(mriqc_dir, "runs_to_exclude.tsv"), sep="\t", index=False
-        )
+def blur_in_mask(in_file, out_file, mask_fn, fwhm):
+    """Blur within the mask with 3dBlurInMask, the in-mask blur of 3dTproject -blur."""
+    run_tool(
+        ["3dBlurInMask", "-input", in_file, "-prefix", out_file, "-mask", mask_fn, "-FWHM", fwhm]
+    )
 
 
-def nuisance_reg(
-    preproc_fn, dummy_scans, denoised_fn, regressor_fn, mask_fn, smooth=False, band_pass=False
-):
-    cmd = f"3dTproject \
-                -input {preproc_fn}[{dummy_scans}..$] \
-                -polort 1 \
-                -prefix {denoised_fn} \
-                -ort {regressor_fn} \
-                -mask {mask_fn}"
-    if smooth:
-        cmd = cmd + " -blur 6"
-    if band_pass:
-        cmd = cmd + " -passband 0.01 0.10"
-    print(f"\t\t{cmd}", flush=True)
-    os.system(cmd)
-
-
-def afni2nifti(afni_fn, nifti_fn):
-    cmd = f"3dAFNItoNIFTI \
-                -prefix {nifti_fn} \
-                {afni_fn}"
-    print(f"\t\t\t{cmd}", flush=True)
-    os.system(cmd)
+def nuisance_reg(preproc_fn, dummy_scans, regressor_fn, mask_fn, variants):
+    """Denoise a run with several 3dTproject-like variants in a single pass.
+
+    Replaces ``3dTproject -input preproc_fn[dummy_scans..$] -polort 1
+    -ort regressor_fn -mask mask_fn [-passband 0.01 0.10] [-blur 6]`` for each
+    variant, but the BOLD data is read and masked once, each projection basis
+    is built once, and the smoothed variant reuses the band-passed residuals
+    (blurring is applied after the projection, as 3dTproject does). The blur
+    is AFNI's in-mask blur (see blur_in_mask), applied to the residuals
+    written without smoothing. check_nuisance_reg.py compares the variants
+    with 3dTproject on one run.
+
+    Parameters
+    ----------
+    variants : list of dict
+        One dict per output with keys "file", "band_pass", "smooth" and "censor".
+        "censor" holds the indices of the volumes to keep (None keeps all of
+        them); censored volumes are dropped in memory before the blur and the
+        write, replacing the former 3dTcat round trip.
+    """
+    import nibabel as nib
+
+    print(f"\t\tNuisance regression: {[op.basename(x['file']) for x in variants]}", flush=True)
+    img = nib.load(preproc_fn)
+    mask = np.asanyarray(nib.load(mask_fn).dataobj) > 0
+    data = img.get_fdata(dtype=np.float32)[mask][:, dummy_scans:]
+    img.uncache()
+    n_vols = data.shape[1]
+    zooms = img.header.get_zooms()
+    t_r = float(zooms[3])
+
+    regressors = np.loadtxt(regressor_fn, ndmin=2)
+    assert regressors.shape[0] == n_vols
+    design = np.column_stack((legendre_polort(n_vols, 1), regressors))
+
+    header = img.header.copy()
+    header.set_data_dtype(np.float32)
+
+    residuals = {}
+    for band_pass in sorted({x["band_pass"] for x in variants}):
+        if band_pass:
+            stopband = stopband_regressors(n_vols, t_r, (0.01, 0.10))
+            basis = projection_basis(np.column_stack((design, stopband)))
+        else:
+            basis = projection_basis(design)
+        basis = basis.astype(np.float32)
+        residuals[band_pass] = data - (data @ basis) @ basis.T
+    del data
+
+    for variant in variants:
+        residual = residuals[variant["band_pass"]]
+        if variant.get("censor") is not None:
+            residual = residual[:, variant["censor"]]
+        out_data = np.zeros(mask.shape + (residual.shape[1],), dtype=np.float32)
+        out_data[mask] = residual
+        out_img = nib.Nifti1Image(out_data, img.affine, header)
+        if variant["smooth"]:
+            # Uncompressed scratch copy of the residuals, next to the output
+            unsmoothed_file = op.join(
+                op.dirname(variant["file"]), f"unsmoothed_{op.basename(variant['file'])}"
+            ).replace(".nii.gz", ".nii")
+            nib.save(out_img, unsmoothed_file)
+            del out_img, out_data
+            blur_in_mask(unsmoothed_file, variant["file"], mask_fn, 6)
+            os.remove(unsmoothed_file)
+        else:
+            nib.save(out_img, variant["file"])
 
 
 def get_reho(denoised_fn, reho_fn, mask_fn):
-    cmd = f"3dReHo \
-                -inset {denoised_fn} \
-                -prefix {reho_fn} \
-                -nneigh 27 \
-                -mask {mask_fn}"
-    print(f"\t\t\t{cmd}", flush=True)
-    os.system(cmd)
+    run_tool(
+        ["3dReHo", "-inset", denoised_fn, "-prefix", reho_fn, "-nneigh", "27", "-mask", mask_fn]
+    )
 
 
 def rsfc_metrics(denoised_fn, rsfc_fn, mask_fn):
-    cmd = f"3dRSFC \
-                -input {denoised_fn} \
-                -prefix {rsfc_fn} \
-                -band 0 99999 \
-                -nodetrend \
-                -mask {mask_fn}"
-    print(f"\t\t\t{cmd}", flush=True)
-    os.system(cmd)
+    run_tool(
+        [
+            "3dRSFC",
+            "-input",
+            denoised_fn,
+            "-prefix",
+            rsfc_fn,
+            "-band",
+            "0",
+            "99999",
+            "-nodetrend",
+            "-mask",
+            mask_fn,
+        ]
+    )
 
 
 def power_spectrum(denoised_fn, rsfc_fn, censor_fn, mask_fn):
-    cmd = f"3dLombScargle \
-                -inset {denoised_fn} \
-                -prefix {rsfc_fn} \
-                -censor_1D {censor_fn} \
-                -mask {mask_fn} \
-                -nifti"
-    print(f"\t\t\t{cmd}", flush=True)
-    os.system(cmd)
+    run_tool(
+        [
+            "3dLombScargle",
+            "-inset",
+            denoised_fn,
+            "-prefix",
+            rsfc_fn,
+            "-censor_1D",
+            censor_fn,
+            "-mask",
+            mask_fn,
+            "-nifti",
+        ]
+    )
 
 
 def rsfc_spectrum2metrics(rsfc_fn, mask_fn):
-    cmd = f"3dAmpToRSFC \
-                -in_amp {rsfc_fn}_amp.nii.gz \
-                -prefix {rsfc_fn} \
-                -band 0.01  0.1 \
-                -mask {mask_fn} \
-                -nifti"
-    print(f"\t\t\t{cmd}", flush=True)
-    os.system(cmd)
-
-
-def normalize_metric(metric_nifti_file, metric_norm_file, mask_fn):
-    # Remove NaNs
-    cmd = f"fslmaths \
-                {metric_nifti_file} \
-                -nan \
-                {metric_nifti_file}"
-    print(f"\t\t\t\t{cmd}", flush=True)
-    os.system(cmd)
-
-    cmd = f"fslstats {metric_nifti_file} -M"
-    print(f"\t\t\t\t{cmd}", flush=True)
-    meanMetric = run_command(cmd)
-
-    cmd = f"fslstats {metric_nifti_file} -S"
-    print(f"\t\t\t\t{cmd}", flush=True)
-    stdMetric = run_command(cmd)
-
-    cmd = f"fslmaths \
-                {metric_nifti_file} \
-                -sub {meanMetric} \
-                -div {stdMetric} \
-                -mul {mask_fn} \
-                {metric_norm_file}"
-    print(f"\t\t\t\t{cmd}", flush=True)
-    os.system(cmd)
+    run_tool(
+        [
+            "3dAmpToRSFC",
+            "-in_amp",
+            f"{rsfc_fn}_amp.nii.gz",
+            "-prefix",
+            rsfc_fn,
+            "-band",
+            "0.01",
+            "0.1",
+            "-mask",
+            mask_fn,
+            "-nifti",
+        ]
+    )
+
+
+def normalize_metrics(metric_files, metric_norm_files, mask_fn):
+    """Z-score a batch of metric maps in one pass.
+
+    Vectorized replacement for ``fslmaths -nan``, ``fslstats -M``, ``fslstats -S``
+    and ``fslmaths -sub -div -mul mask`` on every map: NaNs are set to 0, and the
+    mean and (n - 1) standard deviation are taken over the nonzero voxels of each
+    map, as fslstats does.
+    """
+    import nibabel as nib
+
+    print(f"\t\t\tNormalizing: {[op.basename(x) for x in metric_files]}", flush=True)
+    mask = np.asanyarray(nib.load(mask_fn).dataobj).astype(np.float32)
+    metric_imgs = [nib.load(x) for x in metric_files]
+    data = np.stack([np.reshape(img.get_fdata(), mask.shape) for img in metric_imgs])
+    data = np.where(np.isnan(data), 0, data)
+
+    flat = data.reshape(len(metric_files), -1)
+    n_nonzero = np.count_nonzero(flat, axis=1)
+    mean = flat.sum(axis=1) / n_nonzero
+    var = (np.square(flat).sum(axis=1) - n_nonzero * np.square(mean)) / (n_nonzero - 1)
+    std = np.sqrt(var)
+
+    norm_data = (data - mean[:, None, None, None]) / std[:, None, None, None] * mask
+    for metric_img, metric_norm_file, metric_norm_data in zip(
+        metric_imgs, metric_norm_files, norm_data
+    ):
+        header = metric_img.header.copy()
+        header.set_data_dtype(np.float32)
+        norm_img = nib.Nifti1Image(metric_norm_data.astype(np.float32), metric_img.affine, header)
+        nib.save(norm_img, metric_norm_file)
 
 
 def run_3dtproject(
-    mriqc_dir, preproc_file, mask_file, confounds_file, dummy_scans, fd_thresh, out_dir, desc_list
+    mriqc_dir,
+    preproc_file,
+    mask_file,
+    confounds_file,
+    dummy_scans,
+    fd_thresh,
+    out_dir,
+    desc_list,
+    run_index=None,
+    scratch_ext=".nii.gz",
 ):
     preproc_name = op.basename(preproc_file)
     prefix = preproc_name.split("desc-")[0].rstrip("_")
     preproc_json_file = preproc_file.replace(".nii.gz", ".json")
 
-    # Determine output files
-    denoised_file = op.join(out_dir, f"{prefix}_desc-temp_bold.nii.gz")
-    reho_file = op.join(out_dir, f"{prefix}_desc-REHO_REHO")
+    # Determine output files. The intermediates only live in the nodes' temporary directories
+    denoised_file = op.join(out_dir, f"{prefix}_desc-temp_bold{scratch_ext}")
+    reho_file = op.join(out_dir, f"{prefix}_desc-REHO_REHO{scratch_ext}")
     reho_norm_file = op.join(out_dir, f"{prefix}_desc-REHOnorm_REHO.nii.gz")
     rsfc_file = op.join(out_dir, f"{prefix}_desc-RSFC")
     rsfc_norm_file = op.join(out_dir, f"{prefix}_desc-RSFCnorm")
-    denoisedFilt_file = op.join(out_dir, f"{prefix}_desc-tempFilt_bold.nii.gz")
-    denoisedFiltSM_file = op.join(out_dir, f"{prefix}_desc-tempFiltSM6_bold.nii.gz")
     censFilt_file = op.join(out_dir, f"{prefix}_desc-{desc_list[0]}_bold.nii.gz")
     censFiltSM_file = op.join(out_dir, f"{prefix}_desc-{desc_list[1]}_bold.nii.gz")
 
-    # Create regressor file
     regressor_file = op.join(out_dir, f"{prefix}_regressors.1D")
-    if not op.exists(regressor_file):
-        # Create regressor matrix
-        motionpar = get_motionpar(confounds_file, derivatives=True)
-        acompcor = get_acompcor(confounds_file)
-        gsr = get_gsr(confounds_file)
-        nuisance_regressors = np.column_stack((motionpar, acompcor, gsr))
+    censor_file = op.join(out_dir, f"{prefix}_censoring{fd_thresh}.1D")
 
-        # Some fMRIPrep nuisance regressors have NaN in the first row (e.g., derivatives)
-        nuisance_regressors = np.nan_to_num(nuisance_regressors, 0)
-        nuisance_regressors = np.delete(nuisance_regressors, range(dummy_scans), axis=0)
-        np.savetxt(regressor_file, nuisance_regressors, fmt="%.5f")
+    timer = StageTimer()
 
-    # Create censoring file
+    workflow = Workflow(op.join(out_dir, f"{prefix}_manifest.json"), tool_versions(("afni",)))
+    regressor_node = workflow.node(
+        "regressors", [confounds_file], [regressor_file], {"dummy_scans": dummy_scans}
+    )
     fd_before = 1
     fd_contig = 0
     fd_after = 1
-    censor_file = op.join(out_dir, f"{prefix}_censoring{fd_thresh}.1D")
-    if not op.exists(censor_file):
-        fd_cens = fd_censoring(confounds_file, fd_thresh)
+    censor_node = workflow.node(
+        "censoring",
+        [confounds_file],
+        [censor_file],
+        {
+            "fd_thresh": fd_thresh,
+            "dummy_scans": dummy_scans,
+            "n_contig": fd_contig,
+            "n_before": fd_before,
+            "n_after": fd_after,
+        },
+    )
+
+    # Parse the confounds TSV and JSON once for the regressors and the censoring
+    if regressor_node.stale or censor_node.stale:
+        with timer("confounds"):
+            confounds = Confounds(confounds_file)
+
+    # Create regressor file
+    if regressor_node.stale:
+        # Create regressor matrix: 12 motion, 5 CSF + 5 WM aCompCor and GSR
+        print("\t\tGet aCompCor", flush=True)
+        print(f"\t\t\tComponents: {confounds.acompcor_labels}", flush=True)
+
+        # Some fMRIPrep nuisance regressors have NaN in the first row (e.g., derivatives)
+        nuisance_regressors = np.nan_to_num(confounds.nuisance[dummy_scans:], copy=True)
+        np.savetxt(regressor_node.tmp(regressor_file), nuisance_regressors, fmt="%.5f")
+        regressor_node.commit()
+
+    # Create censoring file
+    if censor_node.stale:
+        fd_cens = fd_censoring(confounds, fd_thresh)
         censor_data = enhance_censoring(
             fd_cens, n_contig=fd_contig, n_before=fd_before, n_after=fd_after
         )[dummy_scans:]
-        np.savetxt(censor_file, censor_data, fmt="%d")
-        tr_keep = np.where(censor_data == 1)[0].tolist()
-    else:
-        tr_censor = pd.read_csv(censor_file, header=None)
-        tr_keep = tr_censor.index[tr_censor[0] == 1].tolist()
+        np.savetxt(censor_node.tmp(censor_file), censor_data, fmt="%d")
+        censor_node.commit()
+    tr_keep = np.flatnonzero(np.loadtxt(censor_file, ndmin=1) == 1).tolist()
 
     # Add runs with < 100 volumes to outlier file
     exclude = False
@@ -306,120 +452,123 @@ def run_3dtproject(
         add_outlier(mriqc_dir, run_name)
 
     # Add preproc runs < 375 volumes to outlier file
-    preproc_nvol = get_nvol(preproc_file)
+    preproc_nvol = get_nvol(preproc_file, run_index)
     if preproc_nvol < 365:
         exclude = True
         run_name = preproc_name.split("_space-")[0]
         print(f"\t\tVolumes={preproc_nvol}, adding run {run_name} to outliers", flush=True)
         add_outlier(mriqc_dir, run_name)
 
-    # Denoise + band pass filter
-    if (not op.exists(denoisedFilt_file)) and (not op.exists(censFilt_file)) and (not exclude):
-        nuisance_reg(
-            preproc_file,
-            dummy_scans,
-            denoisedFilt_file,
-            regressor_file,
-            mask_file,
-            smooth=False,
-            band_pass=True,
-        )
-    if (op.exists(denoisedFilt_file)) and (not op.exists(censFilt_file)):
-        cmd = f"3dTcat -prefix {censFilt_file} {denoisedFilt_file}'{tr_keep}'"
-        print(f"\t\t{cmd}", flush=True)
-        os.system(cmd)
-        os.remove(denoisedFilt_file)
-
-    # Denoise + band pass filter + smoothing
-    if (not op.exists(denoisedFiltSM_file)) and (not op.exists(censFiltSM_file)) and (not exclude):
-        nuisance_reg(
-            preproc_file,
-            dummy_scans,
-            denoisedFiltSM_file,
-            regressor_file,
-            mask_file,
-            smooth=True,
-            band_pass=True,
-        )
-    if (op.exists(denoisedFiltSM_file)) and (not op.exists(censFiltSM_file)):
-        cmd = f"3dTcat -prefix {censFiltSM_file} {denoisedFiltSM_file}'{tr_keep}'"
-        print(f"\t\t{cmd}", flush=True)
-        os.system(cmd)
-        os.remove(denoisedFiltSM_file)
+    if exclude:
+        return timer
 
-    # Calculate ReHo.
-    reho_afniH_file = f"{reho_file}+tlrc.HEAD"
-    reho_afniB_file = f"{reho_file}+tlrc.BRIK"
-    reho_nifti_file = f"{reho_file}.nii.gz"
-    if (not op.exists(reho_norm_file)) and (op.exists(censFilt_file)):
-        get_reho(censFilt_file, reho_file, mask_file)
-        afni2nifti(reho_afniH_file, reho_nifti_file)
-        os.remove(reho_afniH_file)
-        os.remove(reho_afniB_file)
-        
-        # Add Normalization
-        normalize_metric(reho_nifti_file, reho_norm_file, mask_file)
-        os.remove(reho_nifti_file)
-
-    # Calculate ALFF, mALFF, fALFF, RSFA, etc.
+    # Denoise + band pass filter, + smoothing, and without filter for ALFF in one regression.
+    # The unfiltered time series only lives in the node's temporary directory.
     metrics = ["ALFF", "FALFF", "FRSFA", "MALFF", "MRSFA", "RSFA"]
-    fALFF_file = f"{rsfc_norm_file}_FALFF.nii.gz"
-    if (not op.exists(denoised_file)) and (not op.exists(fALFF_file)) and (not exclude):
-        nuisance_reg(
-            preproc_file,
-            dummy_scans,
-            denoised_file,
-            regressor_file,
-            mask_file,
-            smooth=False,
-            band_pass=False,
-        )
-    amp_file = f"{rsfc_file}_amp.nii.gz"
-    if (not op.exists(amp_file)) and (not op.exists(fALFF_file)) and (op.exists(denoised_file)):
-        power_spectrum(denoised_file, rsfc_file, censor_file, mask_file)
-        os.remove(denoised_file)
-
-    if (not op.exists(fALFF_file)) and (op.exists(amp_file)):
-        rsfc_spectrum2metrics(rsfc_file, mask_file)
+    metric_norm_files = [f"{rsfc_norm_file}_{metric}.nii.gz" for metric in metrics]
+    node = workflow.node(
+        "denoise",
+        [preproc_file, mask_file, regressor_file, censor_file],
+        [censFilt_file, censFiltSM_file] + metric_norm_files,
+        {"dummy_scans": dummy_scans},
+    )
+    if node.stale:
+        variants = [
+            {
+                "file": node.tmp(censFilt_file),
+                "band_pass": True,
+                "smooth": False,
+                "censor": tr_keep,
+            },
+            {
+                "file": node.tmp(censFiltSM_file),
+                "band_pass": True,
+                "smooth": True,
+                "censor": tr_keep,
+            },
+            {"file": node.tmp(denoised_file), "band_pass": False, "smooth": False, "censor": None},
+        ]
+        with timer("nuisance_reg"):
+            nuisance_reg(preproc_file, dummy_scans, regressor_file, mask_file, variants)
+
+        # Calculate ALFF, mALFF, fALFF, RSFA, etc.
+        with timer("power_spectrum"):
+            power_spectrum(node.tmp(denoised_file), node.tmp(rsfc_file), censor_file, mask_file)
+        with timer("rsfc_metrics"):
+            rsfc_spectrum2metrics(node.tmp(rsfc_file), mask_file)
+        with timer("normalize"):
+            normalize_metrics(
+                [node.tmp(f"{rsfc_file}_{metric}.nii.gz") for metric in metrics],
+                [node.tmp(x) for x in metric_norm_files],
+                mask_file,
+            )
+        node.commit()
 
-        # Normalize metrics
-        for metric in metrics:
-            metric_file = f"{rsfc_file}_{metric}.nii.gz"
-            metric_norm_file = f"{rsfc_norm_file}_{metric}.nii.gz"
-            normalize_metric(metric_file, metric_norm_file, mask_file)
-            os.remove(metric_file)
+    # Calculate ReHo.
+    node = workflow.node("reho", [censFilt_file, mask_file], [reho_norm_file])
+    if node.stale:
+        with timer("reho"):
+            # 3dReHo writes NIfTI directly given a .nii(.gz) prefix
+            get_reho(censFilt_file, node.tmp(reho_file), mask_file)
+        with timer("normalize"):
+            normalize_metrics([node.tmp(reho_file)], [node.tmp(reho_norm_file)], mask_file)
+        node.commit()
 
     # Create json files with Sources and Description fields
-    # Load metadata for writing out later and TR now
-    if (op.exists(censFilt_file)) and (op.exists(censFiltSM_file)):
+    SUFFIXES = {
+        "desc-aCompCorCens_bold": (
+            "Denoising with an aCompCor regression model including 5 PCA components from"
+            "WM and 5 from CSF deepest white matter, 6 motion parameters, and first"
+            "temporal derivatives of motion parameters, and mean GSR."
+        ),
+        "desc-aCompCorSM6Cens_bold": (
+            "Denoising with an aCompCor regression model including 5 PCA components from"
+            "WM and 5 from CSF deepest white matter, 6 motion parameters, and first"
+            "temporal derivatives of motion parameters, and mean GSR. "
+            "Spatial smoothing was applied."
+        ),
+    }
+    json_files = [op.join(out_dir, f"{prefix}_{suffix}.json") for suffix in SUFFIXES]
+    node = workflow.node(
+        "sidecars",
+        [preproc_json_file, censor_file],
+        json_files,
+        {"fd_thresh": fd_thresh, "dummy_scans": dummy_scans},
+    )
+    if node.stale:
+        # Load metadata for writing out later and TR now
         with open(preproc_json_file, "r") as fo:
             json_info = json.load(fo)
         json_info["Sources"] = [censFilt_file, mask_file, regressor_file]
+        # Volumes kept after censoring, indexed after removing the dummy scans
+        json_info["CensoringThreshold"] = fd_thresh
+        json_info["DummyScans"] = dummy_scans
+        json_info["KeptVolumes"] = tr_keep
 
-        SUFFIXES = {
-            "desc-aCompCorCens_bold": (
-                "Denoising with an aCompCor regression model including 5 PCA components from"
-                "WM and 5 from CSF deepest white matter, 6 motion parameters, and first"
-                "temporal derivatives of motion parameters, and mean GSR."
-            ),
-            "desc-aCompCorSM6Cens_bold": (
-                "Denoising with an aCompCor regression model including 5 PCA components from"
-                "WM and 5 from CSF deepest white matter, 6 motion parameters, and first"
-                "temporal derivatives of motion parameters, and mean GSR. "
-                "Spatial smoothing was applied."
-            ),
-        }
-        for suffix, description in SUFFIXES.items():
+        for suffix, suff_json_file in zip(SUFFIXES, json_files):
             nii_file = op.join(out_dir, f"{prefix}_{suffix}.nii.gz")
             assert op.isfile(nii_file)
 
-            suff_json_file = op.join(out_dir, f"{prefix}_{suffix}.json")
-            json_info["Description"] = description
-            with open(suff_json_file, "w") as fo:
+            json_info["Description"] = SUFFIXES[suffix]
+            with open(node.tmp(suff_json_file), "w") as fo:
                 json.dump(json_info, fo, sort_keys=True, indent=4)
+        node.commit()
 
+    return timer
 
-def main(
+
+def timed_run_3dtproject(*args):
+    """Run run_3dtproject and report the wall time of each of its stages."""
+    start = time.perf_counter()
+    timer = run_3dtproject(*args)
+    print(
+        f"\t\tTimings {op.basename(args[1])}: {timer.report()}, "
+        f"total: {time.perf_counter() - start:.1f}s",
+        flush=True,
+    )
+
+
+def denoise_subject(
     mriqc_dir,
     preproc_dir,
     clean_dir,
@@ -430,18 +579,28 @@ def main(
     dummy_scans,
     desc_list,
     n_jobs,
+    run_index=None,
+    scratch_ext=".nii.gz",
+    manufacturers=None,
 ):
-    """Run denoising workflows on a given dataset."""
-    # Taken from Taylor's pipeline: https://github.com/ME-ICA/ddmra
-    fd_thresh = float(fd_thresh)
-    dummy_scans = int(dummy_scans)
-    os.system(f"export OMP_NUM_THREADS={n_jobs}")
+    """Run denoising workflows on the sessions of one subject.
+
+    Without dummy_scans, they are set from the subject's scanner in
+    manufacturers (participant_id to Manufacturer), failing this subject only
+    when it is missing or unknown.
+    """
+    if dummy_scans is None:
+        manufacturer = manufacturers.get(subject)
+        dummy_scans = manufacturer_dummy_scans(manufacturer)
+        if dummy_scans is None:
+            raise ValueError(f"No dummy scans for {subject}, Manufacturer: {manufacturer}")
 
     if sessions[0] is None:
         temp_ses = glob(op.join(clean_dir, subject, "ses-*"))
         if len(temp_ses) > 0:
             sessions = [op.basename(x) for x in temp_ses]
 
+    run_args = []
     for session in sessions:
         if session is not None:
             preproc_subj_func_dir = op.join(preproc_dir, subject, session, "func")
@@ -481,26 +640,104 @@ def main(
         for file, preproc_file in enumerate(preproc_files):
             mask_name = os.path.basename(mask_files[file])
             mask_file = op.join(nuis_subj_dir, mask_name)
-            copyfile(mask_files[file], mask_file)
+            copy2(mask_files[file], mask_file)
 
             print(f"\tProcessing {subject} files:", flush=True)
             print(f"\t\tDenoising: {preproc_file}", flush=True)
             print(f"\t\tMask:      {mask_file}", flush=True)
             print(f"\t\tConfound:  {confounds_files[file]}", flush=True)
-            run_3dtproject(
-                mriqc_dir,
-                preproc_file,
-                mask_file,
-                confounds_files[file],
-                dummy_scans,
-                fd_thresh,
-                nuis_subj_dir,
-                desc_list,
+            run_args.append(
+                (
+                    mriqc_dir,
+                    preproc_file,
+                    mask_file,
+                    confounds_files[file],
+                    dummy_scans,
+                    fd_thresh,
+                    nuis_subj_dir,
+                    desc_list,
+                    run_index,
+                    scratch_ext,
+                )
             )
 
+    # Denoise the runs of every session concurrently, splitting n_jobs between runs and threads
+    n_run_workers, n_threads = split_cores(n_jobs, len(run_args))
+    if n_run_workers == 1:
+        set_threads(n_threads)
+        for args in run_args:
+            timed_run_3dtproject(*args)
+    else:
+        with ProcessPoolExecutor(
+            max_workers=n_run_workers, initializer=set_threads, initargs=(n_threads,)
+        ) as executor:
+            futures = [executor.submit(timed_run_3dtproject, *args) for args in run_args]
+            for future in futures:
+                future.result()
+
+
+def main(
+    mriqc_dir,
+    preproc_dir,
+    clean_dir,
+    subjects,
+    participants_file,
+    start,
+    stop,
+    sessions,
+    space,
+    fd_thresh,
+    dummy_scans,
+    desc_list,
+    n_jobs,
+    run_index,
+    scratch_ext,
+    n_workers,
+    timeout,
+):
+    """Run denoising workflows on a batch of subjects of a given dataset."""
+    # Taken from Taylor's pipeline: https://github.com/ME-ICA/ddmra
+    fd_thresh = float(fd_thresh)
+    set_command_log(op.join(clean_dir, "logs"))
+    set_command_timeout(timeout)
+    subjects = select_subjects(subjects, participants_file, start, stop)
+    manufacturers = None
+    if dummy_scans is None:
+        participants_df = pd.read_csv(
+            participants_file, sep="\t", usecols=["participant_id", "Manufacturer"]
+        )
+        manufacturers = participants_df.set_index("participant_id")["Manufacturer"].to_dict()
+    else:
+        dummy_scans = int(dummy_scans)
+
+    failed = run_subjects(
+        denoise_subject,
+        subjects,
+        n_workers,
+        mriqc_dir=mriqc_dir,
+        preproc_dir=preproc_dir,
+        clean_dir=clean_dir,
+        sessions=sessions,
+        space=space,
+        fd_thresh=fd_thresh,
+        dummy_scans=dummy_scans,
+        desc_list=desc_list,
+        n_jobs=n_jobs,
+        run_index=run_index,
+        scratch_ext=scratch_ext,
+        manufacturers=manufacturers,
+    )
+    if len(failed) > 0:
+        sys.exit(1)
+
 
 def _main(argv=None):
-    option = _get_parser().parse_args(argv)
+    parser = _get_parser()
+    option = parser.parse_args(argv)
+    if option.subjects is None and option.participants_file is None:
+        parser.error("--participants_file is required without --subjects")
+    if option.dummy_scans is None and option.participants_file is None:
+        parser.error("--dummy_scans is required without --participants_file")
     kwargs = vars(option)
     main(**kwargs)
 
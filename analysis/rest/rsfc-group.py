@@ -1,13 +1,27 @@
 import argparse
 import os
 import os.path as op
-import string
+import sys
 from glob import glob
 
 import nibabel as nib
 import numpy as np
 import pandas as pd
-from nilearn import image, masking
+
+sys.path.append("/code")
+from utils import (
+    OutlierRegistry,
+    RunIndex,
+    Workflow,
+    cached_resample,
+    get_kept_volumes,
+    read_table,
+    run_tool,
+    set_command_log,
+    set_command_timeout,
+    set_threads,
+    tool_versions,
+)
 
 
 def _get_parser():
@@ -78,9 +92,11 @@ def _get_parser():
     )
     parser.add_argument(
         "--roi",
-        dest="roi",
-        required=True,
-        help="ROI label",
+        dest="rois",
+        default=None,
+        required=False,
+        nargs="+",
+        help="ROI labels to analyze. Default: every ROI of --roi_lst, sharing all subject work",
     )
     parser.add_argument(
         "--n_jobs",
@@ -88,44 +104,71 @@ def _get_parser():
         required=True,
         help="CPUs",
     )
+    parser.add_argument(
+        "--run_index",
+        dest="run_index",
+        default=None,
+        required=False,
+        help="Run index (see run_index.py). Default: <dset>/derivatives/run_index.tsv",
+    )
+    parser.add_argument(
+        "--mask_threshold",
+        dest="mask_threshold",
+        default=0.5,
+        type=float,
+        required=False,
+        help="Fraction of the run masks a voxel must be in to enter the group mask",
+    )
+    parser.add_argument(
+        "--scratch_ext",
+        dest="scratch_ext",
+        default=".nii.gz",
+        choices=[".nii.gz", ".nii"],
+        required=False,
+        help="Extension of the intermediate images. .nii (uncompressed) is faster on scratch",
+    )
+    parser.add_argument(
+        "--timeout",
+        dest="timeout",
+        default=None,
+        type=float,
+        required=False,
+        help="Seconds after which an AFNI tool (e.g., 3dttest++) is killed. Default: 12 hours",
+    )
     return parser
 
 
-def afni2nifti(afni_fn, nifti_fn):
-    cmd = f"3dAFNItoNIFTI \
-                -prefix {nifti_fn} \
-                {afni_fn}"
-    print(f"\t\t\t{cmd}", flush=True)
-    os.system(cmd)
+# 3dttest++ covariate labels and the behavioral columns they come from
+COVARIATES = {
+    "age_p": "demo_prnt_age_v2",
+    "age_c": "interview_age",
+    "site": "site_id_l",
+    "education": "demo_prnt_ed_v2",
+    "income": "demo_comb_income_v2",
+    "nativity_p": "demo_prnt_origin_v2",
+    "nativity_c": "demo_origin_v2",
+    "gender_p": "demo_prnt_gender_id_v2",
+    "gender_c": "demo_gender_id_v2",
+}
 
 
 def conn_resample(roi_in, roi_out, template):
-
-    cmd = f"3dresample \
-            -prefix {roi_out} \
-            -master {template} \
-            -inset {roi_in}"
-    print(f"\t\t\t{cmd}", flush=True)
-    os.system(cmd)
+    run_tool(["3dresample", "-prefix", roi_out, "-master", template, "-inset", roi_in])
 
 
 def remove_ouliers(mriqc_dir, briks_files, mask_files):
 
-    runs_to_exclude_df = pd.read_csv(op.join(mriqc_dir, "runs_to_exclude.tsv"), sep="\t")
-    runs_to_exclude = runs_to_exclude_df["bids_name"].tolist()
-    prefixes_tpl = tuple(runs_to_exclude)
+    registry = OutlierRegistry(op.join(mriqc_dir, "runs_to_exclude.tsv"))
 
-    clean_briks_files = [x for x in briks_files if not op.basename(x).startswith(prefixes_tpl)]
-    clean_mask_files = [x for x in mask_files if not op.basename(x).startswith(prefixes_tpl)]
+    clean_briks_files = registry.filter(briks_files)
+    clean_mask_files = registry.filter(mask_files)
 
     return clean_briks_files, clean_mask_files
 
 
 def remove_families(participants_df, briks_files, mask_files):
 
-    subjects_to_exclude = participants_df.loc[
-        participants_df["FamConf"] == 1, "participant_id"
-    ].tolist()
+    subjects_to_exclude = participants_df.index[participants_df["FamConf"] == 1].tolist()
     prefixes_tpl = tuple(subjects_to_exclude)
 
     clean_briks_files = [x for x in briks_files if not op.basename(x).startswith(prefixes_tpl)]
@@ -137,7 +180,7 @@ def remove_families(participants_df, briks_files, mask_files):
 def remove_missingdat(covariates_df, briks_files, mask_files):
     covariates_df = covariates_df.replace([999, 777], np.nan)
     covariates_df = covariates_df.dropna()
-    subjects_to_keep = covariates_df["participant_id"].tolist()
+    subjects_to_keep = covariates_df.index.tolist()
 
     prefixes_tpl = tuple(subjects_to_keep)
 
@@ -147,40 +190,97 @@ def remove_missingdat(covariates_df, briks_files, mask_files):
     return clean_briks_files, clean_mask_files
 
 
-def subj_ave_roi(clean_subj_dir, subj_briks_files, subjAve_roi_briks_file, roi_idx):
+def group_mask(mask_files, target_file, threshold, cache_dir, run_index, n_jobs):
+    """Voxels within more than a threshold fraction of the masks, streaming the masks.
+
+    One running count volume is kept, so memory does not grow with the number
+    of masks, which are loaded by a pool of threads. Masks off the grid of
+    target_file are resampled to a cached copy (see utils.cached_resample) and
+    never modified. As with nilearn's intersect_masks, threshold 1 is the
+    intersection, 0 the union, and the largest connected component is kept.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    from scipy import ndimage
+
+    target_img = nib.load(target_file)
+    target_grid = run_index.grid(target_file)
+
+    def load_mask(mask_file):
+        if run_index.grid(mask_file) != target_grid:
+            mask_file = cached_resample(mask_file, target_file, cache_dir)
+        return np.asanyarray(nib.load(mask_file).dataobj).reshape(target_img.shape[:3]) > 0
+
+    count = np.zeros(target_img.shape[:3], dtype=np.int32)
+    chunk_size = 4 * n_jobs
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        for start in range(0, len(mask_files), chunk_size):
+            for mask in executor.map(load_mask, mask_files[start : start + chunk_size]):
+                count += mask
+
+    mask = count > min(threshold, 1 - 1e-7) * len(mask_files)
+    labels, n_labels = ndimage.label(mask)
+    if n_labels > 1:
+        mask = labels == np.argmax(np.bincount(labels.ravel())[1:]) + 1
+    return nib.Nifti1Image(mask.astype(np.int8), target_img.affine)
+
+
+def run_weights(clean_dir, session, briks_files, cache_file):
+    """Number of volumes left in the time series of each run, from a cached table.
+
+    The counts of the runs missing from cache_file, or whose bucket changed
+    since (by mtime), are read with get_kept_volumes and the table is updated.
+    """
+    mtimes = {x: os.stat(x).st_mtime_ns for x in briks_files}
+    cached = {}
+    if op.exists(cache_file):
+        cache_df = pd.read_csv(cache_file, sep="\t")
+        cached = dict(zip(cache_df["bucket"], zip(cache_df["mtime"], cache_df["kept_volumes"])))
+
+    weights = {}
+    for briks_file in briks_files:
+        mtime, kept_volumes = cached.get(op.basename(briks_file), (None, None))
+        if mtime != mtimes[briks_file]:
+            subject = op.basename(briks_file).split("_")[0]
+            prefix = op.basename(briks_file).split("desc-")[0].rstrip("_")
+            clean_subj_dir = op.join(clean_dir, subject, session, "func")
+            kept_volumes = len(get_kept_volumes(clean_subj_dir, prefix))
+        weights[briks_file] = int(kept_volumes)
+
+    cache_df = pd.DataFrame(
+        {
+            "bucket": [op.basename(x) for x in briks_files],
+            "mtime": [mtimes[x] for x in briks_files],
+            "kept_volumes": [weights[x] for x in briks_files],
+        }
+    )
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    cache_df.to_csv(tmp_file, sep="\t", index=False)
+    os.replace(tmp_file, cache_file)
+    return weights
+
+
+def subj_ave_roi(weight_lst, subj_briks_files, subjAve_roi_briks_file, roi_idx):
+    """Run-weighted average of the roi_idx sub-bricks, one output volume per index.
+
+    Reads each run's bucket once. Matches the former 3dcalc expression
+    (a*w[1]+b*w[2]+...)/n_runs, with the weights normalized to sum to 1,
+    without its limit of 26 runs.
+    """
     n_runs = len(subj_briks_files)
-    letters = list(string.ascii_lowercase[0:n_runs])
+    weights = np.asarray(weight_lst, dtype=np.float64) / np.sum(weight_lst) / n_runs
 
-    subj_roi_briks_files = [
-        "-{0} {1}'[{2}]'".format(letters[idx], x.split(".HEAD")[0], roi_idx)
-        for idx, x in enumerate(subj_briks_files)
-    ]
-    input_str = " ".join(subj_roi_briks_files)
-
-    # Get weights from number of volumes left in the time series
-    weight_lst = []
-    for subj_briks_file in subj_briks_files:
-        prefix = op.basename(subj_briks_file).split("desc-")[0].rstrip("_")
-        censor_files = glob(op.join(clean_subj_dir, f"{prefix}_censoring*.1D"))
-        assert len(censor_files) == 1
-        censor_file = censor_files[0]
-        tr_censor = pd.read_csv(censor_file, header=None)
-        tr_left = len(tr_censor.index[tr_censor[0] == 1].tolist())
-        weight_lst.append(tr_left)
-    # Normalize weights
-    weight_norm_lst = [float(x) / sum(weight_lst) for x in weight_lst]
-
-    # Conform equation (a*w[1]+b*w[2]+...)/n_runs
-    equation = [f"{letters[idx]}*{round(w,4)}" for idx, w in enumerate(weight_norm_lst)]
-    if n_runs > 1:
-        equation_str = "+".join(equation)
-        exp_str = f"({equation_str})/{n_runs}"
-    else:
-        exp_str = f"{equation[0]}"
+    ave_data = None
+    for weight, subj_briks_file in zip(weights, subj_briks_files):
+        img = nib.load(subj_briks_file)
+        # AFNI buckets may be stored as 5D (x, y, z, 1, sub-bricks)
+        data = np.asanyarray(img.dataobj).reshape(img.shape[:3] + (-1,))[..., roi_idx]
+        if ave_data is None:
+            ave_data = np.zeros(data.shape, dtype=np.float32)
+            affine = img.affine
+        ave_data += np.float32(weight) * data
 
-    cmd = f"3dcalc {input_str} -expr '{exp_str}' -prefix {subjAve_roi_briks_file}"
-    print(f"\t{cmd}", flush=True)
-    os.system(cmd)
+    nib.save(nib.Nifti1Image(ave_data, affine), subjAve_roi_briks_file)
 
 
 def subj_mean_fd(preproc_subj_dir, subj_briks_files, subj_mean_fd_file):
@@ -202,98 +302,174 @@ def subj_mean_fd(preproc_subj_dir, subj_briks_files, subj_mean_fd_file):
     return mean_fd
 
 
-def writearg_1sample(onettest_args_fn):
-    with open(onettest_args_fn, "w") as fo:
-        fo.write("-setA Group\n")
-
-
-def append2arg_1sample(subject, subjAve_roi_briks_file, onettest_args_fn):
-    brik_id = "{brik}'[0]'".format(brik=subjAve_roi_briks_file)
-    with open(onettest_args_fn, "a") as fo:
-        fo.write(f"{subject} {brik_id}\n")
+def subject_covariates(subjects, behavioral_df, participants_df):
+    """Covariates and group probabilities of every subject, joined in one pass.
+
+    Sites are coded by their sorted labels, so the coding does not depend on
+    the row order of the behavioral table. Subjects missing from the
+    behavioral table, or without a site, are dropped from the sample and
+    reported; their other missing covariates are set to 0.
+    """
+    behavioral_df = behavioral_df[~behavioral_df.index.duplicated()].copy()
+    sites = behavioral_df["site_id_l"]
+    behavioral_df["site_id_l"] = pd.Categorical(sites, categories=sorted(sites.dropna().unique()))
+    behavioral_df["site_id_l"] = behavioral_df["site_id_l"].cat.codes
+
+    subjectkeys = pd.Index(["NDAR_{}".format(x.split("sub-NDAR")[1]) for x in subjects])
+    missing = ~subjectkeys.isin(behavioral_df.index)
+    # Missing sites are coded -1
+    no_site = (behavioral_df["site_id_l"].reindex(subjectkeys) == -1).to_numpy()
+    drop = missing | no_site
+    if drop.any():
+        print(
+            f"Dropping {missing.sum()} subjects missing from the behavioral table and "
+            f"{no_site.sum()} subjects without a site: "
+            f"{[x for x, dropped in zip(subjects, drop) if dropped]}",
+            flush=True,
+        )
+    cov_df = behavioral_df.loc[subjectkeys[~drop], list(COVARIATES.values())].fillna(0)
+    cov_df.columns = list(COVARIATES)
+    cov_df.index = pd.Index(
+        [x for x, dropped in zip(subjects, drop) if not dropped], name="subject"
+    )
+    groups_df = participants_df[["CProb1", "CProb2"]]
+    return cov_df.join(groups_df)
 
 
-def get_setAB(subject, subjAve_roi_briks_file, participants_df, setA, setB):
-    sub_df = participants_df[participants_df["participant_id"] == subject]
-    brik_id = "{brik}'[0]'".format(brik=subjAve_roi_briks_file)
-    if sub_df["CProb1"].values[0] >= 0.7:
-        setA.append("{sub_id} {brik_id}\n".format(sub_id=subject, brik_id=brik_id))
-    elif sub_df["CProb2"].values[0] >= 0.7:
-        setB.append("{sub_id} {brik_id}\n".format(sub_id=subject, brik_id=brik_id))
-    else:
-        pass
-    return setA, setB
+def write_ttest_inputs(
+    cov_df, subjAve_files, roi_vol, onettest_args_fn, onettest_cov_fn, twottest_args_fn
+):
+    """Write the 1-sample arguments and covariates and the 2-sample arguments, each at once."""
+    brik_ids = {
+        subject: f"{subject} {subjAve_briks_file}'[{roi_vol}]'\n"
+        for subject, (subjAve_briks_file, _) in subjAve_files.items()
+    }
+    with open(onettest_args_fn, "w") as fo:
+        fo.write("-setA Group\n" + "".join(brik_ids[x] for x in cov_df.index))
 
+    # "FD",
+    with open(onettest_cov_fn, "w") as fo:
+        fo.write(cov_df[list(COVARIATES)].to_csv(sep=" ", index_label="subject"))
 
-def writearg_2sample(setA, setB, twottest_args_fn):
-    setA = "".join(setA)
-    setB = "".join(setB)
+    in_setA = cov_df["CProb1"] >= 0.7
+    in_setB = ~in_setA & (cov_df["CProb2"] >= 0.7)
+    setA = "".join(brik_ids[x] for x in cov_df.index[in_setA])
+    setB = "".join(brik_ids[x] for x in cov_df.index[in_setB])
     with open(twottest_args_fn, "w") as fo:
         fo.write(f"-setA Bicult\n{setA}\n-setB Detached\n{setB}\n")
 
 
-def writecov_1sample(onettest_cov_fn):
-    cov_labels = [
-        "subject",
-        "age_p",
-        "age_c",
-        "site",
-        "education",
-        "income",
-        "nativity_p",
-        "nativity_c",
-        "gender_p",
-        "gender_c",
-    ]
-    # "FD",
-    with open(onettest_cov_fn, "w") as fo:
-        fo.write("{}\n".format(" ".join(cov_labels)))
+def run_ttest(bucket_fn, mask_fn, covariates_file, args_file, n_jobs, out_dir):
+    # 3dttest++ writes its ClustSim and ETAC outputs to the working directory
+    run_tool(
+        [
+            "3dttest++",
+            "-prefix",
+            bucket_fn,
+            "-mask",
+            mask_fn,
+            "-Covariates",
+            covariates_file,
+            "-Clustsim",
+            n_jobs,
+            "-ETAC",
+            n_jobs,
+            "-ETAC_opt",
+            "NN=2:sid=2:hpow=0:pthr=0.05,0.01,0.005,0.002,0.001:name=etac",
+            "-@",
+        ],
+        cwd=out_dir,
+        stdin_file=args_file,
+    )
 
 
-def append2cov_1sample(subject, mean_fd, behavioral_df, onettest_cov_fn):
-    # TODO: This function need to be generalized
-    site_dict = {site: i for i, site in enumerate(behavioral_df["site_id_l"].unique())}
-    sub_df = behavioral_df[
-        behavioral_df["subjectkey"] == "NDAR_{}".format(subject.split("sub-NDAR")[1])
-    ]
-    sub_df = sub_df.fillna(0)
-    age_p = sub_df["demo_prnt_age_v2"].values[0]
-    age_c = sub_df["interview_age"].values[0]
-    site = site_dict[sub_df["site_id_l"].values[0]]
-    education = sub_df["demo_prnt_ed_v2"].values[0]
-    income = sub_df["demo_comb_income_v2"].values[0]
-    nativity_p = sub_df["demo_prnt_origin_v2"].values[0]
-    nativity_c = sub_df["demo_origin_v2"].values[0]
-    gender_p = sub_df["demo_prnt_gender_id_v2"].values[0]
-    gender_c = sub_df["demo_gender_id_v2"].values[0]
-    cov_variables = [
-        subject,
-        age_p,
-        age_c,
-        site,
-        education,
-        income,
-        nativity_p,
-        nativity_c,
-        gender_p,
-        gender_c,
-    ]
-    # mean_fd,
-    cov_variables_str = [str(x) for x in cov_variables]
-    with open(onettest_cov_fn, "a") as fo:
-        fo.write("{}\n".format(" ".join(cov_variables_str)))
+def roi_ttests(
+    roi,
+    roi_vol,
+    subjAve_files,
+    cov_df,
+    group_mask_fn,
+    rsfc_group_dir,
+    session,
+    group,
+    versions,
+    n_jobs,
+):
+    """Run the one- and two-sample t-tests of one ROI, volume roi_vol of the subject averages."""
+    roi_dir = op.join(rsfc_group_dir, roi)
+    os.makedirs(roi_dir, exist_ok=True)
+    workflow = Workflow(
+        op.join(roi_dir, f"sub-group_{session}_task-rest_desc-{roi}_manifest.json"), versions
+    )
+
+    # Conform onettest_args_fn and twottest_args_fn
+    onettest_args_fn = op.join(
+        roi_dir, f"sub-group_{session}_task-rest_desc-1SampletTest{roi}_args.txt"
+    )
+    twottest_args_fn = op.join(
+        roi_dir, f"sub-group_{session}_task-rest_desc-2SampletTest{roi}_args.txt"
+    )
+
+    # Conform onettest_cov_fn and twottest_cov_fn
+    onettest_cov_fn = op.join(
+        roi_dir, f"sub-group_{session}_task-rest_desc-1SampletTest{roi}_cov.txt"
+    )
+
+    # Write the t-test arguments and covariates of the whole sample at once
+    node = workflow.node(
+        "ttest-inputs",
+        [x for x, _ in subjAve_files.values()],
+        [onettest_args_fn, onettest_cov_fn, twottest_args_fn],
+        {
+            "subjects": sorted(subjAve_files),
+            "group": group,
+            "roi_vol": roi_vol,
+            "covariates": int(pd.util.hash_pandas_object(cov_df).sum()),
+        },
+    )
+    if node.stale:
+        write_ttest_inputs(
+            cov_df,
+            subjAve_files,
+            roi_vol,
+            node.tmp(onettest_args_fn),
+            node.tmp(onettest_cov_fn),
+            node.tmp(twottest_args_fn),
+        )
+        node.commit()
 
+    # Statistical analysis
+    # Whole-brain, one-sample t-tests
+    onettest_briks_fn = op.join(
+        roi_dir,
+        f"sub-group_{session}_task-rest_desc-1SampletTest{roi}_briks",
+    )
+    # Whole-brain, two-sample t-tests
+    twottest_briks_fn = op.join(
+        roi_dir,
+        f"sub-group_{session}_task-rest_desc-2SampletTest{roi}_briks",
+    )
+    ttest_briks_files = [onettest_briks_fn, twottest_briks_fn]
+    covariates_files = [onettest_cov_fn, onettest_cov_fn]
+    args_files = [onettest_args_fn, twottest_args_fn]
 
-def run_ttest(bucket_fn, mask_fn, covariates_file, args_file, n_jobs):
-    cmd = f"3dttest++ -prefix {bucket_fn} \
-            -mask {mask_fn} \
-            -Covariates {covariates_file} \
-            -Clustsim {n_jobs} \
-            -ETAC {n_jobs} \
-            -ETAC_opt NN=2:sid=2:hpow=0:pthr=0.05,0.01,0.005,0.002,0.001:name=etac \
-            -@ < {args_file}"
-    print(f"\t\t{cmd}", flush=True)
-    os.system(cmd)
+    for file, ttest_briks_fn in enumerate(ttest_briks_files):
+        node = workflow.node(
+            op.basename(ttest_briks_fn),
+            [group_mask_fn, covariates_files[file], args_files[file]]
+            + [x for x, _ in subjAve_files.values()],
+            [f"{ttest_briks_fn}.nii.gz"],
+        )
+        if node.stale:
+            run_ttest(
+                f"{op.basename(ttest_briks_fn)}.nii.gz",
+                group_mask_fn,
+                covariates_files[file],
+                args_files[file],
+                n_jobs,
+                op.dirname(node.tmp(ttest_briks_fn)),
+            )
+            node.commit(move_all=True)
 
 
 def main(
@@ -307,23 +483,49 @@ def main(
     template_mask,
     group,
     roi_lst,
-    roi,
+    rois,
     n_jobs,
+    run_index,
+    mask_threshold,
+    scratch_ext,
+    timeout,
 ):
     """Run group analysis workflows on a given dataset."""
-    os.system(f"export OMP_NUM_THREADS={n_jobs}")
+    set_threads(n_jobs)
+    set_command_log(op.join(rsfc_dir, "logs"))
+    set_command_timeout(timeout)
+    # Fisher z of the partial correlation of each seed in the [Corr, Z, Tstat] bucket of
+    # rsfc.py, no longer atanh of the 3dREMLfit coefficient (see seed_connectivity)
     roi_dict = {label: x * 3 + 1 for x, label in enumerate(roi_lst)}
     print(roi_dict, flush=True)
+    if rois is None:
+        rois = roi_lst
     space = "MNI152NLin2009cAsym"
     n_jobs = int(n_jobs)
-    # Load important tsv files
-    participants_df = pd.read_csv(op.join(dset, "participants.tsv"), sep="\t")
-    covariates_df = pd.read_csv(op.join(dset, "derivatives", "covariates.tsv"), sep="\t")
-    behavioral_df = pd.read_csv(
+    # Voxel grids are looked up in the run index instead of loading every image
+    if run_index is None:
+        run_index = op.join(dset, "derivatives", "run_index.tsv")
+    run_index = RunIndex.load(run_index)
+    # Load important tsv files, through Parquet copies refreshed when the tables change
+    table_cache_dir = op.join(dset, "derivatives", "table_cache")
+    participants_df = read_table(
+        op.join(dset, "participants.tsv"),
+        columns=["participant_id", "FamConf", "CProb1", "CProb2"],
+        index_col="participant_id",
+        cache_dir=table_cache_dir,
+    )
+    covariates_df = read_table(
+        op.join(dset, "derivatives", "covariates.tsv"),
+        index_col="participant_id",
+        cache_dir=table_cache_dir,
+    )
+    behavioral_df = read_table(
         op.join(
             dset, "derivatives", "ltnx_demo_via_lt_acspsw03_asr_cbcl_crpbi_pmq_pfe_pfes_tbss.csv"
         ),
-        sep="\t",
+        columns=["subjectkey"] + list(COVARIATES.values()),
+        index_col="subjectkey",
+        cache_dir=table_cache_dir,
     )
 
     # Define directories
@@ -338,7 +540,7 @@ def main(
     # Collect important files
     print(rsfc_subjs_dir)
     briks_files = sorted(
-        glob(op.join(rsfc_subjs_dir, f"*task-rest*_space-{space}*_desc-norm_bucketREML+tlrc.HEAD"))
+        glob(op.join(rsfc_subjs_dir, f"*task-rest*_space-{space}*_desc-norm_bucket.nii.gz"))
     )
     mask_files = sorted(
         glob(op.join(rsfc_subjs_dir, f"*task-rest*_space-{space}*_desc-brain_mask.nii.gz"))
@@ -381,50 +583,37 @@ def main(
             for tmp_brik_fn in clean_briks_files:
                 fo.write(f"{tmp_brik_fn}\n")
 
+    versions = tool_versions(("afni",))
+    # Two nodes per subject: the manifest is saved every 500 nodes and after the last subject
+    group_workflow = Workflow(
+        op.join(rsfc_group_dir, f"sub-group_{session}_task-rest_manifest.json"),
+        versions,
+        save_every=500,
+    )
+
     # Create group mask
     group_mask_fn = op.join(
         rsfc_group_dir, f"sub-group_{session}_task-rest_space-{space}_desc-brain_mask.nii.gz"
     )
-    if not op.exists(group_mask_fn):
+    mask_inputs = clean_mask_files if template_mask is None else clean_mask_files + [template_mask]
+    node = group_workflow.node(
+        "group-mask", mask_inputs, [group_mask_fn], {"threshold": mask_threshold}
+    )
+    if node.stale:
         if template_mask is None:
-            for clean_mask_file in clean_mask_files:
-                clean_mask_obj = image.load_img(clean_mask_file)
-                if clean_mask_obj.shape[0] == 81:
-                    affine, shape = clean_mask_obj.affine, clean_mask_obj.shape
-                    break
+            target_file = next(x for x in clean_mask_files if run_index.shape(x)[0] == 81)
         else:
-            template_mask_obj = image.load_img(template_mask)
-            affine, shape = template_mask_obj.affine, template_mask_obj.shape
-        for clean_mask_file in clean_mask_files:
-            clean_mask_img = image.load_img(clean_mask_file)
-            if clean_mask_img.shape[0] != 81:
-                clean_res_mask_img = image.resample_img(
-                    clean_mask_img, affine, shape[:3], interpolation="nearest"
-                )
-                nib.save(clean_res_mask_img, clean_mask_file)
-
-        group_mask = masking.intersect_masks(clean_mask_files, threshold=0.5)
-        nib.save(group_mask, group_mask_fn)
-
-    roi_dir = op.join(rsfc_group_dir, roi)
-    os.makedirs(roi_dir, exist_ok=True)
-
-    # Conform onettest_args_fn and twottest_args_fn
-    onettest_args_fn = op.join(
-        roi_dir, f"sub-group_{session}_task-rest_desc-1SampletTest{roi}_args.txt"
-    )
-    twottest_args_fn = op.join(
-        roi_dir, f"sub-group_{session}_task-rest_desc-2SampletTest{roi}_args.txt"
-    )
-    if not op.exists(onettest_args_fn):
-        writearg_1sample(onettest_args_fn)
-
-    # Conform onettest_cov_fn and twottest_cov_fn
-    onettest_cov_fn = op.join(
-        roi_dir, f"sub-group_{session}_task-rest_desc-1SampletTest{roi}_cov.txt"
-    )
-    if not op.exists(onettest_cov_fn):
-        writecov_1sample(onettest_cov_fn)
+            target_file = template_mask
+        group_mask_img = group_mask(
+            clean_mask_files,
+            target_file,
+            mask_threshold,
+            op.join(rsfc_group_dir, "resampled_masks"),
+            run_index,
+            n_jobs,
+        )
+        nib.save(group_mask_img, node.tmp(group_mask_fn))
+        node.commit()
 
     # Calculate subject and ROI level average connectivity
     subjects = [op.basename(x).split("_")[0] for x in clean_briks_files]
@@ -434,21 +623,26 @@ def main(
     # Get template
     if template is None:
         for clean_briks_file in clean_briks_files:
-            temp_template = op.join(f"{clean_briks_file}'{roi_dict[roi]}'")
-            temp_template_img = image.load_img(temp_template)
-            if temp_template_img.shape[0] == 81:
-                template = temp_template
+            if run_index.shape(clean_briks_file)[0] == 81:
+                template = clean_briks_file
                 print(f"Template {template}")
                 break
     else:
-        assert image.load_img(template).shape[0] == 81
+        assert run_index.shape(template)[0] == 81
+
+    # Volumes left after censoring, weighting each run in its subject's average
+    weights = run_weights(
+        clean_dir,
+        session,
+        clean_briks_files,
+        op.join(rsfc_group_dir, f"sub-group_{session}_task-rest_desc-keptvolumes.tsv"),
+    )
 
-    setA = []
-    setB = []
+    # The subject averages hold one volume per ROI of roi_lst, whichever ROIs are analyzed
+    subjAve_files = {}
     for subject in subjects:
         rsfc_subj_dir = op.join(rsfc_dir, subject, session, "func")
         preproc_subj_dir = op.join(preproc_dir, subject, session, "func")
-        clean_subj_dir = op.join(clean_dir, subject, session, "func")
         subj_briks_files = [x for x in clean_briks_files if subject in x]
 
         if "run-" in subj_briks_files[0]:
@@ -456,83 +650,75 @@ def main(
         else:
             prefix = op.basename(subj_briks_files[0]).split("space-")[0].rstrip("_")
 
-        subjAve_roi_briks_file = op.join(
+        # AFNI writes NIfTI directly given a .nii(.gz) prefix. The average is on the grid of
+        # the subject's runs, and only an intermediate when it has to be resampled.
+        on_grid = run_index.shape(subj_briks_files[0])[0] == 81
+        subjAve_briks_file = op.join(
             rsfc_subj_dir,
-            f"{prefix}_space-{space}_desc-ave{roi}_bucket",
+            f"{prefix}_space-{space}_desc-ave_bucket" + (".nii.gz" if on_grid else scratch_ext),
         )
-        subjAveRes_roi_briks_file = op.join(
+        subjAveRes_briks_file = op.join(
             rsfc_subj_dir,
-            f"{prefix}_space-{space}_desc-ave{roi}res_bucket",
+            f"{prefix}_space-{space}_desc-averes_bucket.nii.gz",
         )
         subj_mean_fd_file = op.join(
             rsfc_subj_dir,
             f"{prefix}_meanFD.txt",
         )
-        if not op.exists(f"{subjAve_roi_briks_file}+tlrc.BRIK"):
-            subj_ave_roi(clean_subj_dir, subj_briks_files, subjAve_roi_briks_file, roi_dict[roi])
+        node = group_workflow.node(
+            f"{subject}_ave",
+            subj_briks_files,
+            [subjAve_briks_file],
+            {
+                "weights": [weights[x] for x in subj_briks_files],
+                "roi_idx": [roi_dict[x] for x in roi_lst],
+            },
+        )
+        if node.stale:
+            subj_ave_roi(
+                node.signature["params"]["weights"],
+                subj_briks_files,
+                node.tmp(subjAve_briks_file),
+                node.signature["params"]["roi_idx"],
+            )
+            node.commit()
 
         # Resample
-        subjAve_roi_briks = image.load_img(f"{subjAve_roi_briks_file}+tlrc.BRIK")
-        if subjAve_roi_briks.shape[0] != 81:
-            if not op.exists(f"{subjAveRes_roi_briks_file}+tlrc.BRIK"):
-                conn_resample(
-                    f"{subjAve_roi_briks_file}+tlrc",
-                    subjAveRes_roi_briks_file,
-                    template,
-                )
-            subjAve_roi_briks_file = subjAveRes_roi_briks_file
-        if (op.exists(f"{subjAve_roi_briks_file}+tlrc.HEAD")) and (
-            not op.exists(f"{subjAve_roi_briks_file}.nii.gz")
-        ):
-            afni2nifti(f"{subjAve_roi_briks_file}+tlrc.HEAD", f"{subjAve_roi_briks_file}.nii.gz")
+        if not on_grid:
+            node = group_workflow.node(
+                f"{subject}_resample",
+                [subjAve_briks_file, template],
+                [subjAveRes_briks_file],
+            )
+            if node.stale:
+                conn_resample(subjAve_briks_file, node.tmp(subjAveRes_briks_file), template)
+                node.commit()
+            subjAve_briks_file = subjAveRes_briks_file
 
         # Get subject level mean FD
         mean_fd = subj_mean_fd(preproc_subj_dir, subj_briks_files, subj_mean_fd_file)
-
-        # Append subject specific info for onettest_args_fn
-        if op.exists(onettest_args_fn):
-            append2arg_1sample(subject, f"{subjAve_roi_briks_file}+tlrc.BRIK", onettest_args_fn)
-
-        # Get setA and setB to write twottest_args_fn
-        # if not op.exists(twottest_args_fn):
-        setA, setB = get_setAB(
-            subject, f"{subjAve_roi_briks_file}+tlrc.BRIK", participants_df, setA, setB
+        subjAve_files[subject] = (subjAve_briks_file, mean_fd)
+    group_workflow.save()
+
+    # Covariates of the whole sample, shared by the t-tests of every ROI
+    cov_df = subject_covariates(list(subjAve_files), behavioral_df, participants_df)
+    subjAve_files = {x: subjAve_files[x] for x in cov_df.index}
+    print(f"Group analysis sample size with covariates: {len(subjAve_files)}", flush=True)
+
+    for roi in rois:
+        roi_ttests(
+            roi,
+            roi_lst.index(roi),
+            subjAve_files,
+            cov_df,
+            group_mask_fn,
+            rsfc_group_dir,
+            session,
+            group,
+            versions,
+            n_jobs,
         )
 
-        # Append subject specific info for onettest_cov_fn
-        if op.exists(onettest_cov_fn):
-            append2cov_1sample(subject, mean_fd, behavioral_df, onettest_cov_fn)
-
-    # Write twottest_args_fn
-    if not op.exists(twottest_args_fn):
-        writearg_2sample(setA, setB, twottest_args_fn)
-
-    # Statistical analysis
-    # Whole-brain, one-sample t-tests
-    onettest_briks_fn = op.join(
-        roi_dir,
-        f"sub-group_{session}_task-rest_desc-1SampletTest{roi}_briks",
-    )
-    # Whole-brain, two-sample t-tests
-    twottest_briks_fn = op.join(
-        roi_dir,
-        f"sub-group_{session}_task-rest_desc-2SampletTest{roi}_briks",
-    )
-    ttest_briks_files = [onettest_briks_fn, twottest_briks_fn]
-    covariates_files = [onettest_cov_fn, onettest_cov_fn]
-    args_files = [onettest_args_fn, twottest_args_fn]
-
-    for file, ttest_briks_fn in enumerate(ttest_briks_files):
-        os.chdir(op.dirname(ttest_briks_fn))
-        if not op.exists(f"{ttest_briks_fn}+tlrc.BRIK"):
-            run_ttest(
-                op.basename(ttest_briks_fn),
-                group_mask_fn,
-                covariates_files[file],
-                args_files[file],
-                n_jobs,
-            )
-
 
 def _main(argv=None):
     option = _get_parser().parse_args(argv)
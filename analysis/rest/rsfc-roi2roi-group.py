@@ -0,0 +1,80 @@
+import argparse
+import os.path as op
+import sys
+from glob import glob
+
+import numpy as np
+
+sys.path.append("/code")
+from utils import ConnectomeStore
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(description="Pack ROI-to-ROI connectomes into group stores")
+    parser.add_argument(
+        "--rsfc_dir",
+        dest="rsfc_dir",
+        required=True,
+        help="Path to ROI-to-ROI RSFC directory",
+    )
+    parser.add_argument(
+        "--store_dir",
+        dest="store_dir",
+        default=None,
+        required=False,
+        help="Path to the group store directory. Default: <rsfc_dir>/group",
+    )
+    parser.add_argument(
+        "--space",
+        dest="space",
+        default="MNI152NLin2009cAsym",
+        required=False,
+        help="Standard space, MNI152NLin2009cAsym",
+    )
+    return parser
+
+
+def main(rsfc_dir, store_dir, space):
+    """Append the connectomes of newly finished runs to one store per atlas."""
+    if store_dir is None:
+        store_dir = op.join(rsfc_dir, "group")
+
+    conn_files = sorted(
+        glob(
+            op.join(rsfc_dir, "sub-*", "**", f"*task-rest*_space-{space}*_desc-roi2roi_conn.npz"),
+            recursive=True,
+        )
+    )
+    print(f"Found {len(conn_files)} connectome files", flush=True)
+
+    stores = {}
+    n_added = {}
+    for conn_file in conn_files:
+        bids_name = op.basename(conn_file).split("_space-")[0]
+        with np.load(conn_file) as conn_data:
+            atlases = [x[: -len("_z")] for x in conn_data.files if x.endswith("_z")]
+            for atlas in atlases:
+                if atlas not in stores:
+                    stores[atlas] = ConnectomeStore(store_dir, atlas)
+                    n_added[atlas] = 0
+                if bids_name in stores[atlas]:
+                    continue
+                n_added[atlas] += stores[atlas].append(
+                    [bids_name],
+                    [conn_data[f"{atlas}_z"]],
+                    conn_data[f"{atlas}_values"],
+                    conn_data[f"{atlas}_labels"],
+                )
+
+    for atlas, store in stores.items():
+        print(f"\t{atlas}: {n_added[atlas]} runs added, {len(store)} runs in {store.prefix}")
+
+
+def _main(argv=None):
+    option = _get_parser().parse_args(argv)
+    kwargs = vars(option)
+    main(**kwargs)
+
+
+if __name__ == "__main__":
+    _main()
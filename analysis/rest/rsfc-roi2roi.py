@@ -1,11 +1,23 @@
 import argparse
 import os
 import os.path as op
+import sys
 from glob import glob
-from shutil import copyfile
+from shutil import copy2
 
+import nibabel as nib
+import numpy as np
 import pandas as pd
 
+sys.path.append("/code")
+from utils import (
+    ROIExtractor,
+    roi_resample,
+    set_command_log,
+    set_command_timeout,
+    set_threads,
+)
+
 
 def _get_parser():
     parser = argparse.ArgumentParser(description="Run RSFC in AFNI")
@@ -62,54 +74,80 @@ def _get_parser():
         required=False,
         help="CPUs",
     )
+    parser.add_argument(
+        "--timeout",
+        dest="timeout",
+        default=None,
+        type=float,
+        required=False,
+        help="Seconds after which an AFNI tool is killed. Default: 12 hours",
+    )
     return parser
 
 
-def roi_resample(roi_in, roi_out, template):
-    cmd = f"3dresample \
-            -prefix {roi_out} \
-            -master {template} \
-            -inset {roi_in}"
-    print(f"\t\t\t{cmd}", flush=True)
-    os.system(cmd)
-
-
-def ave_timeseries(mask, rs_file, rs_timeseries):
-    cmd = f"3dmaskave \
-            -q \
-            -mask {mask} \
-            {rs_file} > {rs_timeseries}"
-    print(f"\t\t\t{cmd}", flush=True)
-    os.system(cmd)
-
-
-def make_label_table(lab_file, lab_table, atlas_img):
-    cmd = f"@MakeLabelTable \
-            -lab_file {lab_file} 1 0   \
-            -labeltable {lab_table} \
-            -dset {atlas_img}"
-    print(f"\t\t\t{cmd}", flush=True)
-    os.system(cmd)
-
-
-def roi2roi_conn(clean_subj_fn, mask_file, atlas_img, rsfc_atlas_subj):
-    cmd = f"3dNetCorr \
-            -inset {clean_subj_fn} \
-            -mask {mask_file} \
-            -in_rois {atlas_img} \
-            -fish_z \
-            -ts_out \
-            -ts_label \
-            -prefix {rsfc_atlas_subj}"
-    print(f"\t\t\t{cmd}", flush=True)
-    os.system(cmd)
-
-
-def main(clean_dir, rsfc_dir, atlas_dir, subject, sessions, space, desc_list, n_jobs):
+def read_label_table(lab_file):
+    """Read an atlas label file with the value in column 0 and the label in column 1."""
+    lab_df = pd.read_csv(lab_file, sep=r"\s+", header=None, comment="#", usecols=[0, 1])
+    return lab_df[0].astype(int).to_numpy(), lab_df[1].astype(str).to_numpy()
+
+
+def roi2roi_conn(clean_subj_fn, mask_file, atlases_info, conn_file):
+    """ROI-to-ROI connectivity for every atlas from a single read of the BOLD data.
+
+    Replaces one 3dNetCorr -fish_z -ts_out call per atlas. Parcel means are
+    taken over the voxels of each parcel inside the brain mask, for all atlases
+    at once through one sparse label matrix, and the time series, correlation
+    and Fisher z matrices of every atlas are stored in a single .npz file along
+    with the label values and names. The diagonal of the z matrices is set to 0.
+    """
+    print(f"\t\tROI-to-ROI connectivity: {conn_file}", flush=True)
+    mask = np.asanyarray(nib.load(mask_file).dataobj) > 0
+    extractor = ROIExtractor()
+    for atlas_name, atlas_info in atlases_info.items():
+        atlas_data = np.rint(np.asanyarray(nib.load(atlas_info["file"]).dataobj)).astype(int)
+        extractor.add_atlas(atlas_data * mask, atlas_name, labels=atlas_info["values"])
+
+    clean_img = nib.load(clean_subj_fn)
+    roi_timeseries = extractor.transform(clean_img.get_fdata(dtype=np.float32))
+    clean_img.uncache()
+
+    roi_atlases = np.array([label[0] for label in extractor.labels])
+    conn_dict = {}
+    for atlas_name, atlas_info in atlases_info.items():
+        timeseries = roi_timeseries[roi_atlases == atlas_name]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            corr = np.corrcoef(timeseries)
+            fisher_z = np.arctanh(corr)
+        np.fill_diagonal(fisher_z, 0)
+        conn_dict[f"{atlas_name}_timeseries"] = timeseries.astype(np.float32)
+        conn_dict[f"{atlas_name}_corr"] = corr.astype(np.float32)
+        conn_dict[f"{atlas_name}_z"] = fisher_z.astype(np.float32)
+        conn_dict[f"{atlas_name}_values"] = atlas_info["values"]
+        conn_dict[f"{atlas_name}_labels"] = atlas_info["labels"]
+    np.savez_compressed(conn_file, **conn_dict)
+
+
+def main(clean_dir, rsfc_dir, atlas_dir, subject, sessions, space, desc_list, n_jobs, timeout):
     """Run denoising workflows on a given dataset."""
-    os.system(f"export OMP_NUM_THREADS={n_jobs}")
+    set_threads(n_jobs)
+    set_command_log(op.join(rsfc_dir, "logs"))
+    set_command_timeout(timeout)
     assert len(desc_list) == 2
     atlases = sorted(glob(op.join(atlas_dir, "*")))
+    resample_cache_dir = op.join(rsfc_dir, "resample_cache")
+
+    # Label values and names of each atlas, from its label file or from the image
+    atlases_labels = {}
+    for atlas in atlases:
+        lab_files = sorted(glob(op.join(atlas, "*.txt")))
+        if len(lab_files) == 0:
+            atlas_imgs = sorted(glob(op.join(atlas, "*.nii.gz")))
+            atlas_data = np.rint(np.asanyarray(nib.load(atlas_imgs[0]).dataobj)).astype(int)
+            atlas_values = np.unique(atlas_data[atlas_data != 0])
+            atlases_labels[op.basename(atlas)] = (atlas_values, atlas_values.astype(str))
+        else:
+            assert len(lab_files) == 1
+            atlases_labels[op.basename(atlas)] = read_label_table(lab_files[0])
 
     if sessions[0] is None:
         temp_ses = glob(op.join(clean_dir, subject, "ses-*"))
@@ -148,41 +186,35 @@ def main(clean_dir, rsfc_dir, atlas_dir, subject, sessions, space, desc_list, n_
 
             mask_name = os.path.basename(mask_files[0])
             mask_file = op.join(rsfc_subj_dir, mask_name)
-            copyfile(mask_files[0], mask_file)
+            copy2(mask_files[0], mask_file)
 
             print(f"\tProcessing {subject}, {session} files:", flush=True)
             print(f"\t\tClean:  {clean_subj_file}", flush=True)
             print(f"\t\tMask:   {mask_file}", flush=True)
 
+            atlases_info = {}
             for atlas in atlases:
                 atlas_name = op.basename(atlas)
                 atlas_imgs = sorted(glob(op.join(atlas, "*.nii.gz")))
                 assert len(atlas_imgs) == 1
                 atlas_img = atlas_imgs[0]
 
-                lab_files = sorted(glob(op.join(atlas, "*.txt")))
-                if len(lab_files) == 0:
-                    # Do not create label table file
-                    make_table = False
-                else:
-                    assert len(lab_files) == 1
-                    lab_file = lab_files[0]
-                    make_table = True
-
                 # Resample atlas
                 atlas_img_res = op.join(rsfc_subj_dir, f"{prefix}_desc-{atlas_name}_atlas.nii.gz")
                 if not op.exists(atlas_img_res):
-                    roi_resample(atlas_img, atlas_img_res, clean_subj_file)
-
-                # Create label table
-                lab_table = op.join(rsfc_subj_dir, f"{prefix}_desc-{atlas_name}_labtable.niml.lt")
-                if (not op.exists(lab_table)) and (make_table):
-                    make_label_table(lab_file, lab_table, atlas_img_res)
-
-                # Calculate RSFC
-                rsfc_atlas_subj = op.join(rsfc_subj_dir, f"{prefix}_desc-{atlas_name}")
-                if not op.exists(f"{rsfc_atlas_subj}_000.netcc"):
-                    roi2roi_conn(clean_subj_file, mask_file, atlas_img_res, rsfc_atlas_subj)
+                    roi_resample(atlas_img, atlas_img_res, clean_subj_file, resample_cache_dir)
+
+                atlas_values, atlas_labels = atlases_labels[atlas_name]
+                atlases_info[atlas_name] = {
+                    "file": atlas_img_res,
+                    "values": atlas_values,
+                    "labels": atlas_labels,
+                }
+
+            # Calculate RSFC for all atlases at once
+            conn_file = op.join(rsfc_subj_dir, f"{prefix}_desc-roi2roi_conn.npz")
+            if not op.exists(conn_file):
+                roi2roi_conn(clean_subj_file, mask_file, atlases_info, conn_file)
 
 
 def _main(argv=None):
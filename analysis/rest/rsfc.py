@@ -1,11 +1,30 @@
 import argparse
+import json
 import os
 import os.path as op
+import sys
 from glob import glob
-from shutil import copyfile
+from shutil import copy2
 
+import nibabel as nib
+import numpy as np
 import pandas as pd
 
+sys.path.append("/code")
+from utils import (
+    OutlierRegistry,
+    ROIExtractor,
+    Workflow,
+    grid_hash,
+    roi_resample,
+    run_subjects,
+    select_subjects,
+    set_command_log,
+    set_command_timeout,
+    set_threads,
+    tool_versions,
+)
+
 
 def _get_parser():
     parser = argparse.ArgumentParser(description="Run RSFC in AFNI")
@@ -28,10 +47,36 @@ def _get_parser():
         help="Path to RSFC directory",
     )
     parser.add_argument(
+        "--subjects",
         "--subject",
-        dest="subject",
-        required=True,
-        help="Subject identifier, with the sub- prefix.",
+        dest="subjects",
+        default=None,
+        required=False,
+        nargs="+",
+        help="Subject identifiers, with the sub- prefix.",
+    )
+    parser.add_argument(
+        "--participants_file",
+        dest="participants_file",
+        default=None,
+        required=False,
+        help="Path to participants.tsv, to select subjects by row",
+    )
+    parser.add_argument(
+        "--start",
+        dest="start",
+        default=None,
+        type=int,
+        required=False,
+        help="First participants_file row (0-based) to process, without --subjects",
+    )
+    parser.add_argument(
+        "--stop",
+        dest="stop",
+        default=None,
+        type=int,
+        required=False,
+        help="Row after the last participants_file row to process, without --subjects",
     )
     parser.add_argument(
         "--sessions",
@@ -69,82 +114,109 @@ def _get_parser():
         required=False,
         help="CPUs",
     )
+    parser.add_argument(
+        "--n_workers",
+        dest="n_workers",
+        default=1,
+        type=int,
+        required=False,
+        help="Subjects processed in parallel",
+    )
+    parser.add_argument(
+        "--timeout",
+        dest="timeout",
+        default=None,
+        type=float,
+        required=False,
+        help="Seconds after which an AFNI tool is killed. Default: 12 hours",
+    )
     return parser
 
 
-def roi_resample(roi_in, roi_out, template):
-    cmd = f"3dresample \
-            -prefix {roi_out} \
-            -master {template} \
-            -inset {roi_in}"
-    print(f"\t\t\t{cmd}", flush=True)
-    os.system(cmd)
-
-
-def ave_timeseries(mask, rs_file, rs_timeseries):
-    cmd = f"3dmaskave \
-            -q \
-            -mask {mask} \
-            {rs_file} > {rs_timeseries}"
-    print(f"\t\t\t{cmd}", flush=True)
-    os.system(cmd)
-
-
-def design_matrix(rs_smooth_fn, mask_fname, num_roi, stim_info, matrix_fname, n_jobs):
-    cmd = f"3dDeconvolve -input {rs_smooth_fn} \
-            -x1D_stop \
-            -mask {mask_fname} \
-            -num_stimts {num_roi} \
-            -jobs {n_jobs} \
-            -svd \
-            -local_times \
-            -basis_normall 1 \
-            {stim_info} \
-            -x1D {matrix_fname}"
-    print(f"\t\t{cmd}", flush=True)
-    os.system(cmd)
-
-
-def connectivity(matrix_fname, rs_smooth_fn, mask_fname, out_bucket):
-    cmd = f"3dREMLfit \
-            -matrix {matrix_fname} \
-            -input {rs_smooth_fn} \
-            -mask {mask_fname} \
-            -fout \
-            -tout \
-            -Rbuck {out_bucket} \
-            -verb"
-    print(f"\t\t{cmd}", flush=True)
-    os.system(cmd)
-
-
-def norm_conn(out_bucket, out_bucket_z):
-    cmd = f'3dcalc \
-            -a {out_bucket}+tlrc \
-            -expr "atanh(a)" \
-            -prefix {out_bucket_z}'
-    print(f"\t\t{cmd}", flush=True)
-    os.system(cmd)
+def ave_timeseries(extractor, rs_file, rs_timeseries_files):
+    """Average rs_file within every ROI of extractor, like 3dmaskave -q, in one read."""
+    print(f"\t\t\tROI averages: {rs_file}", flush=True)
+    rs_img = nib.load(rs_file)
+    roi_means = extractor.transform(rs_img.get_fdata(dtype=np.float32))
+    rs_img.uncache()
+    for roi_mean, rs_timeseries in zip(roi_means, rs_timeseries_files):
+        np.savetxt(rs_timeseries, roi_mean, fmt="%g")
+
+
+def seed_connectivity(rs_smooth_fn, mask_fname, seed_timeseries_files, seed_labels, out_bucket):
+    """Seed-to-voxel connectivity for all seeds with one batched least-squares solve.
+
+    Replaces 3dDeconvolve -x1D_stop, 3dREMLfit and the 3dcalc atanh pass. The
+    masked (n_voxels, n_vols) data are regressed on a -polort 1 baseline plus
+    every seed time series (OLS). For each seed the bucket holds the partial
+    correlation, its Fisher z and the t statistic, in that order, so the
+    z-map of seed i is sub-brick 3 * i + 1.
+
+    The statistic at sub-brick 3 * i + 1 changed with this function. It used
+    to be atanh of the 3dREMLfit coefficient of seed i, from a design with
+    unit-peak seeds (-basis_normall 1), 3dDeconvolve's automatic -polort and
+    ARMA(1,1) noise. It is now the Fisher z of the OLS partial correlation
+    with a -polort 1 baseline, so group results are not comparable with
+    buckets made before.
+    """
+    print(f"\t\tSeed connectivity: {out_bucket}", flush=True)
+    img = nib.load(rs_smooth_fn)
+    mask = np.asanyarray(nib.load(mask_fname).dataobj) > 0
+    data = img.get_fdata(dtype=np.float32)[mask]
+    img.uncache()
+    n_vols = data.shape[1]
+
+    seeds = np.column_stack([np.loadtxt(x, ndmin=1) for x in seed_timeseries_files])
+    assert seeds.shape[0] == n_vols
+    baseline = np.column_stack((np.ones(n_vols), np.linspace(-1, 1, n_vols)))
+    design = np.column_stack((baseline, seeds))
+    xtx_inv = np.linalg.pinv(design.T @ design)
+    dof = n_vols - np.linalg.matrix_rank(design)
+
+    betas = data @ (design @ xtx_inv).astype(np.float32)
+    residuals = data - betas @ design.T.astype(np.float32)
+    del data
+    sigma2 = np.einsum("ij,ij->i", residuals, residuals, dtype=np.float64) / dof
+    del residuals
+
+    n_base = baseline.shape[1]
+    std_err = np.sqrt(sigma2[:, None] * np.diag(xtx_inv)[None, n_base:])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        tstat = np.where(std_err > 0, betas[:, n_base:] / std_err, 0)
+    corr = tstat / np.sqrt(tstat**2 + dof)
+    fisher_z = np.arctanh(corr)
+
+    n_seeds = seeds.shape[1]
+    bucket = np.zeros(mask.shape + (3 * n_seeds,), dtype=np.float32)
+    bucket[mask] = np.stack((corr, fisher_z, tstat), axis=2).reshape(-1, 3 * n_seeds)
+    header = img.header.copy()
+    header.set_data_dtype(np.float32)
+    nib.save(nib.Nifti1Image(bucket, img.affine, header), out_bucket)
+
+    bucket_info = {
+        "Sources": [rs_smooth_fn, mask_fname] + list(seed_timeseries_files),
+        "SubBrickLabels": [
+            f"{label}_{stat}" for label in seed_labels for stat in ["Corr", "Z", "Tstat"]
+        ],
+        "DegreesOfFreedom": int(dof),
+    }
+    with open(out_bucket.replace(".nii.gz", ".json"), "w") as fo:
+        json.dump(bucket_info, fo, sort_keys=True, indent=4)
 
 
 def add_outlier(mriqc_dir, prefix):
-
-    runs_to_exclude_df = pd.read_csv(op.join(mriqc_dir, "runs_to_exclude.tsv"), sep="\t")
-
-    if runs_to_exclude_df["bids_name"].str.contains(prefix).any():
+    registry = OutlierRegistry(op.join(mriqc_dir, "runs_to_exclude.tsv"))
+    if not registry.add(prefix):
         print(f"\t\t\t{prefix} already in runs_to_exclude.tsv")
-    else:
-        runs_exclude_df = runs_to_exclude_df.append({"bids_name": f"{prefix}"}, ignore_index=True)
-        runs_exclude_df = runs_exclude_df.drop_duplicates(subset=["bids_name"])
-        runs_exclude_df["bids_name"].to_csv(
-            op.join(mriqc_dir, "runs_to_exclude.tsv"), sep="\t", index=False
-        )
 
 
-def main(mriqc_dir, clean_dir, rsfc_dir, subject, sessions, space, desc_list, rois, n_jobs):
-    """Run denoising workflows on a given dataset."""
-    os.system(f"export OMP_NUM_THREADS={n_jobs}")
+def rsfc_subject(
+    mriqc_dir, clean_dir, rsfc_dir, subject, sessions, space, desc_list, rois, n_jobs
+):
+    """Run RSFC workflows on the sessions of one subject."""
+    set_threads(n_jobs)
     assert len(desc_list) == 2
+    resample_cache_dir = op.join(rsfc_dir, "resample_cache")
     if sessions[0] is None:
         temp_ses = glob(op.join(clean_dir, subject, "ses-*"))
         if len(temp_ses) > 0:
@@ -197,7 +269,7 @@ def main(mriqc_dir, clean_dir, rsfc_dir, subject, sessions, space, desc_list, ro
 
             mask_name = os.path.basename(mask_files[0])
             mask_file = op.join(rsfc_subj_dir, mask_name)
-            copyfile(mask_files[0], mask_file)
+            copy2(mask_files[0], mask_file)
 
             print(f"\tProcessing {subject}, {session}, {rois} files:", flush=True)
             print(f"\t\tClean:   {clean_subj_file}", flush=True)
@@ -209,33 +281,51 @@ def main(mriqc_dir, clean_dir, rsfc_dir, subject, sessions, space, desc_list, ro
             clean_subj_name = op.basename(clean_subj_file)
             subj_prefix = clean_subj_name.split("desc-")[0].rstrip("_")
 
-            exclude = False
-            stim_info = ""
-            for i, roi in enumerate(rois):
-                num = i + 1
+            workflow = Workflow(
+                op.join(rsfc_subj_dir, f"{prefix}_manifest.json"), tool_versions(("afni",))
+            )
+
+            roi_prefixes = []
+            roi_res_files = []
+            # The target grid is a parameter, so a run on a new grid resamples the ROIs again
+            grid = grid_hash(clean_subj_file)
+            for roi in rois:
                 roi_name = op.basename(roi)
                 roi_prefix = roi_name.split("_")[0].split("-")[1]
                 roi_res = op.join(rsfc_subj_dir, f"{prefix}_desc-{roi_prefix}_mask.nii.gz")
-                if not op.exists(roi_res):
-                    roi_resample(roi, roi_res, clean_subj_file)
-
-                # Average time series of each voxel within each ROIs
-                roi_subj_timeseries = op.join(
-                    rsfc_subj_dir, f"{subj_prefix}_desc-{roi_prefix}_timeseries.txt"
-                )
-                # Average fALFF of each voxel within each ROIs
-                roi_subj_falff = op.join(
-                    rsfc_subj_dir, f"{subj_prefix}_desc-{roi_prefix}_FALFF.txt"
-                )
-                # Average ReHo of each voxel within each ROIs
-                roi_subj_reho = op.join(rsfc_subj_dir, f"{subj_prefix}_desc-{roi_prefix}_REHO.txt")
-                if not op.exists(roi_subj_timeseries):
-                    ave_timeseries(roi_res, clean_subj_file, roi_subj_timeseries)
-                if not op.exists(roi_subj_falff):
-                    ave_timeseries(roi_res, falff_subj_file, roi_subj_falff)
-                if not op.exists(roi_subj_reho):
-                    ave_timeseries(roi_res, reho_subj_file, roi_subj_reho)
+                node = workflow.node(f"resample-{roi_prefix}", [roi], [roi_res], {"grid": grid})
+                if node.stale:
+                    roi_resample(roi, node.tmp(roi_res), clean_subj_file, resample_cache_dir)
+                    node.commit()
+                roi_prefixes.append(roi_prefix)
+                roi_res_files.append(roi_res)
+
+            # Average time series, fALFF and ReHo of each voxel within each ROIs
+            roi_subj_files = {
+                rs_file: [
+                    op.join(rsfc_subj_dir, f"{subj_prefix}_desc-{roi_prefix}_{suffix}.txt")
+                    for roi_prefix in roi_prefixes
+                ]
+                for rs_file, suffix in [
+                    (clean_subj_file, "timeseries"),
+                    (falff_subj_file, "FALFF"),
+                    (reho_subj_file, "REHO"),
+                ]
+            }
+            roi_average_files = [x for files in roi_subj_files.values() for x in files]
+            node = workflow.node(
+                "roi-averages", list(roi_subj_files) + roi_res_files, roi_average_files
+            )
+            if node.stale:
+                extractor = ROIExtractor()
+                for roi_res in roi_res_files:
+                    extractor.add_mask(np.asanyarray(nib.load(roi_res).dataobj), roi_res)
+                for rs_file, rs_timeseries_files in roi_subj_files.items():
+                    ave_timeseries(extractor, rs_file, [node.tmp(x) for x in rs_timeseries_files])
+                node.commit()
 
+            exclude = False
+            for roi_subj_timeseries in roi_subj_files[clean_subj_file]:
                 roi_subj_timeseries_df = pd.read_csv(roi_subj_timeseries, header=None)
                 non_zero = len(
                     roi_subj_timeseries_df.index[roi_subj_timeseries_df[0] != 0].tolist()
@@ -246,37 +336,67 @@ def main(mriqc_dir, clean_dir, rsfc_dir, subject, sessions, space, desc_list, ro
                     print(f"\t\tAdding run {run_name} to outliers", flush=True)
                     add_outlier(mriqc_dir, run_name)
 
-                # Conform stim_info for 3dDeconvolve
-                stim_info += f"-stim_file {num} {roi_subj_timeseries} "
-                stim_info += f'-stim_label {num} "{roi_res}" '
-
-            # Conform design matrix using 3dDeconvolve
-            des_subj_matrix = op.join(rsfc_subj_dir, f"{subj_prefix}_dmatrix.1D")
-            if (not op.exists(des_subj_matrix)) and (not exclude):
-                design_matrix(
+            # Calculate seed-to-voxel connectivity (correlation, Fisher z and t) for all ROIs
+            bucket_subj_z = op.join(rsfc_subj_dir, f"{subj_prefix}_desc-norm_bucket.nii.gz")
+            node = workflow.node(
+                "seed-connectivity",
+                [smooth_subj_file, mask_file] + roi_subj_files[clean_subj_file],
+                [bucket_subj_z, bucket_subj_z.replace(".nii.gz", ".json")],
+                {"rois": roi_prefixes},
+            )
+            if node.stale and (not exclude):
+                seed_connectivity(
                     smooth_subj_file,
                     mask_file,
-                    len(rois),
-                    stim_info,
-                    des_subj_matrix,
-                    n_jobs,
+                    roi_subj_files[clean_subj_file],
+                    roi_prefixes,
+                    node.tmp(bucket_subj_z),
                 )
-
-            # Calculate connectivity using the GLM in 3dREMLfit
-            bucket_subj_reml = op.join(rsfc_subj_dir, f"{subj_prefix}_bucketREML")
-            if (not op.exists(f"{bucket_subj_reml}+tlrc.BRIK")) and (op.exists(des_subj_matrix)):
-                connectivity(des_subj_matrix, smooth_subj_file, mask_file, bucket_subj_reml)
-
-            # Normalize correlations
-            bucket_subj_reml_z = op.join(rsfc_subj_dir, f"{subj_prefix}_desc-norm_bucketREML")
-            if (not op.exists(f"{bucket_subj_reml_z}+tlrc.BRIK")) and (
-                op.exists(f"{bucket_subj_reml}+tlrc.BRIK")
-            ):
-                norm_conn(bucket_subj_reml, bucket_subj_reml_z)
+                node.commit()
+
+
+def main(
+    mriqc_dir,
+    clean_dir,
+    rsfc_dir,
+    subjects,
+    participants_file,
+    start,
+    stop,
+    sessions,
+    space,
+    desc_list,
+    rois,
+    n_jobs,
+    n_workers,
+    timeout,
+):
+    """Run RSFC workflows on a batch of subjects of a given dataset."""
+    set_command_log(op.join(rsfc_dir, "logs"))
+    set_command_timeout(timeout)
+    subjects = select_subjects(subjects, participants_file, start, stop)
+    failed = run_subjects(
+        rsfc_subject,
+        subjects,
+        n_workers,
+        mriqc_dir=mriqc_dir,
+        clean_dir=clean_dir,
+        rsfc_dir=rsfc_dir,
+        sessions=sessions,
+        space=space,
+        desc_list=desc_list,
+        rois=rois,
+        n_jobs=n_jobs,
+    )
+    if len(failed) > 0:
+        sys.exit(1)
 
 
 def _main(argv=None):
-    option = _get_parser().parse_args(argv)
+    parser = _get_parser()
+    option = parser.parse_args(argv)
+    if option.subjects is None and option.participants_file is None:
+        parser.error("--participants_file is required without --subjects")
     kwargs = vars(option)
     main(**kwargs)
 
@@ -4,8 +4,12 @@ Based on
 https://github.com/BIDS-Apps/example/blob/aa0d4808974d79c9fbe54d56d3b47bb2cf4e0a0d/run.py
 """
 import argparse
-import os
 import os.path as op
+import shlex
+import sys
+
+sys.path.append('/home/data/abcd/code/abcd_fmriprep-analysis')
+from utils import run_tool, set_command_log, set_command_timeout
 
 
 def get_parser():
@@ -17,12 +21,17 @@ def get_parser():
                         help='The label of the subject to analyze.')
     parser.add_argument('--ses', required=False, dest='ses',
                         help='Session number', default=None)
+    parser.add_argument('--timeout', required=False, dest='timeout', type=float,
+                        help='Seconds after which an AFNI tool is killed. Default: 12 hours',
+                        default=None)
     return parser
 
 
 def main(argv=None):
 
     args = get_parser().parse_args(argv)
+    set_command_log(op.join(args.bids_dir, 'derivatives', 'fmriprep_post-process', 'logs'))
+    set_command_timeout(args.timeout)
 
     for run in ['1', '2', '1+2']:
         in_file = op.join(args.bids_dir,
@@ -342,7 +351,7 @@ def main(argv=None):
 
         if run == '1+2':
             cmd+=' -concat {concat_fn}'.format(concat_fn=concat_fn)
-        os.system(cmd)
+        run_tool(shlex.split(cmd))
 
         cmd='3dREMLfit -matrix {design_fn} \
                        -input {in_file} \
@@ -354,7 +363,7 @@ def main(argv=None):
                                      in_file=in_file,
                                      mask_fn=mask_fn,
                                      bucket_fn=bucket_fn)
-        os.system(cmd)
+        run_tool(shlex.split(cmd))
 
 
 if __name__ == '__main__':
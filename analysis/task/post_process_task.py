@@ -18,7 +18,8 @@ from nilearn.image import smooth_img
 from nipype.interfaces.fsl import Merge
 
 sys.path.append('/home/data/abcd/code/abcd_fmriprep-analysis')
-from utils import enhance_censoring, fd_censoring, motion_parameters
+from utils import (Confounds, RunIndex, enhance_censoring, fd_censoring,
+                   manufacturer_dummy_scans, motion_parameters, raw_sidecar)
 
 
 def get_parser():
@@ -32,6 +33,9 @@ def get_parser():
                         help='Session number', default=None)
     parser.add_argument('--task', required=True, dest='task',
                         help='Task ID (mid, nback, sst)', default=None)
+    parser.add_argument('--run_index', required=False, dest='run_index',
+                        help=('Run index (see run_index.py). Default: '
+                              '<bidsdir>/derivatives/run_index.tsv'), default=None)
     return parser
 
 
@@ -42,6 +46,9 @@ def main(argv=None):
     fmriprep_dir = op.join(args.bids_dir, 'derivatives', 'fmriprep-21.0.0')
     output_dir = op.join(args.bids_dir, 'derivatives', 'fmriprep_post-process', args.sub, args.ses, args.task)
     os.makedirs(output_dir, exist_ok=True)
+    if args.run_index is None:
+        args.run_index = op.join(args.bids_dir, 'derivatives', 'run_index.tsv')
+    run_index = RunIndex.load(args.run_index)
 
     #framewise displacement parameters
     fd_thresh = 0.9
@@ -82,14 +89,11 @@ def main(argv=None):
         # first 5 TRs (GE). GE is weird bc it actually acquires 16 TRs, where the first
         # 12 TRs are averaged into one image, and the remaining 4 are normal
 
-        js_fname = op.join(args.bids_dir, args.sub, args.ses, 'func', '{scan_base}_bold.json'.format(scan_base=op.basename(scan_base)))
-        js_fname = js_fname.replace('run-', 'run-0')
-        js_data = json.load(open(js_fname))
-        manufacturer = js_data['Manufacturer']
-        if 'GE' in manufacturer:
-            trs_to_delete = 5
-        elif ('Philips' in manufacturer) or ('Siemens' in manufacturer):
-            trs_to_delete = 8
+        # The manufacturer is looked up in the run index, or else in the raw sidecar
+        trs_to_delete = run_index.dummy_scans(scan)
+        if trs_to_delete is None:
+            with open(raw_sidecar(scan, args.bids_dir)) as js_fo:
+                trs_to_delete = manufacturer_dummy_scans(json.load(js_fo)['Manufacturer'])
 
         tmp_img = nib.load(scan)
 
@@ -123,7 +127,8 @@ def main(argv=None):
 
         # now handle FD censoring and motion parameters
         tmp_regressor_file = '{}_desc-confounds_timeseries.tsv'.format(scan_base)
-        fd_cens = fd_censoring(tmp_regressor_file, fd_thresh)
+        tmp_confounds = Confounds(tmp_regressor_file, groups=('motion', 'fd'))
+        fd_cens = fd_censoring(tmp_confounds, fd_thresh)
         tmp_censor_data = enhance_censoring(fd_cens, n_contig=fd_contig, n_before=fd_before, n_after=fd_after)[trs_to_delete:]
         tmp_censor_out_name = op.join(output_dir,
                                 '{}_motion_censoring.1D'.format(op.basename(scan_base)))
@@ -133,7 +138,7 @@ def main(argv=None):
         else:
             censor_data = np.append(censor_data, tmp_censor_data)
 
-        tmp_motion_regressors = motion_parameters(tmp_regressor_file).drop(index=np.arange(trs_to_delete))
+        tmp_motion_regressors = motion_parameters(tmp_confounds).drop(index=np.arange(trs_to_delete))
         tmp_motion_out_name = op.join(output_dir,
                                 '{}_motion_parameters.1D'.format(op.basename(scan_base)))
         tmp_motion_regressors.to_csv(tmp_motion_out_name, sep=' ', header=False, index=False)
@@ -1,9 +1,21 @@
 import argparse
+import json
+import os
 import os.path as op
-from glob import glob
+from fnmatch import fnmatch
 
 import pandas as pd
 
+# Stages in pipeline order, with the file name pattern of a completed run
+STAGES = {
+    "MRIQC": "sub-*_task-rest*_bold.html",
+    "fMRIPrep": "sub-*_task-rest*_desc-preproc_bold.nii.gz",
+    "Denoising": "sub-*_task-rest*_bold.nii.gz",
+    # Not the subject averages (desc-ave/desc-averes) that rsfc-group.py writes next to them
+    "RSFC": "sub-*_task-rest*_desc-norm_bucket.nii.gz",
+}
+RAW_PATTERN = "sub-*_task-rest*_bold.nii.gz"
+
 
 def _get_parser():
     parser = argparse.ArgumentParser(description="Get subjects to download")
@@ -46,68 +58,160 @@ def _get_parser():
     return parser
 
 
-def main(dset, fmriprep_dir, mriqc_dir, denoising_dir, rsfc_dir, session):
-    """Generate list of subject ID from participants.tsv but not in dset"""
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def run_key(file_name):
+    """(session, run) of a BIDS file name, with the run label unpadded (run-01 == run-1)."""
+    entities = dict(x.split("-", 1) for x in file_name.split("_") if "-" in x)
+    session = f"ses-{entities['ses']}" if "ses" in entities else ""
+    run = entities.get("run", "")
+    return session, run.lstrip("0") or run
+
+
+def scan_tree(root, pattern, cache):
+    """Names of the files matching pattern per subject, walking root once with os.scandir.
+
+    Only the ses-*/func directories of each subject are walked. cache holds
+    the directory mtimes and the files found by the previous call, per subject;
+    a subject whose directories did not change since is not read again.
+    """
+    with os.scandir(root) as entries:
+        subject_dirs = [x.path for x in entries if x.name.startswith("sub-") and x.is_dir()]
+
+    subjects = {}
+    n_read = 0
+    for subject_dir in subject_dirs:
+        subject = op.basename(subject_dir)
+        cached = cache.get(subject)
+        if cached is not None and all(
+            _mtime(op.join(root, x)) == mtime for x, mtime in cached["mtimes"].items()
+        ):
+            subjects[subject] = cached
+            continue
+
+        n_read += 1
+        mtimes = {}
+        files = []
+        to_walk = [subject_dir]
+        while to_walk:
+            directory = to_walk.pop()
+            # The mtime is taken before listing, so that a file added meanwhile is seen next time
+            mtimes[op.relpath(directory, root)] = _mtime(directory)
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        if entry.name.startswith("ses-") or entry.name == "func":
+                            to_walk.append(entry.path)
+                    elif fnmatch(entry.name, pattern):
+                        files.append(entry.name)
+        subjects[subject] = {"mtimes": mtimes, "files": sorted(files)}
+    print(f"\t{root}: {n_read}/{len(subject_dirs)} subjects read", flush=True)
+    return subjects
+
+
+def scan_flat(root, pattern, cache):
+    """Names of the files matching pattern per subject, in a flat directory (MRIQC reports)."""
+    mtime = _mtime(root)
+    if cache.get("mtime") != mtime:
+        with os.scandir(root) as entries:
+            files = sorted(x.name for x in entries if fnmatch(x.name, pattern))
+        cache = {"mtime": mtime, "files": files}
+        print(f"\t{root}: read", flush=True)
+    subjects = {}
+    for file_name in cache["files"]:
+        subjects.setdefault(file_name.split("_")[0], []).append(file_name)
+    return cache, {x: {"files": files} for x, files in subjects.items()}
 
-    participant_ids_fn = op.join(dset, "participants.tsv")
-    participant_ids_df = pd.read_csv(participant_ids_fn, sep="\t")
-    participant_ids = participant_ids_df["participant_id"].tolist()
 
-    # Get competed MRIQC
-    mriqc_files = sorted(glob(op.join(mriqc_dir, "sub-*_task-rest*_bold.html")))
-    mriqc_ids_lst = [op.basename(x).split("_")[0] for x in mriqc_files]
-    mriqc_ids_lst = set(mriqc_ids_lst)
+def main(dset, fmriprep_dir, mriqc_dir, denoising_dir, rsfc_dir, session):
+    """Report the completed runs of each pipeline stage and the stage blocking each subject.
+
+    completion.tsv holds one row per participant of participants.tsv with a
+    0/1 column per stage (any run of the session done) and the first stage,
+    in pipeline order, that is not done. completion_runs.tsv holds the same
+    per session and run, for the runs of the raw dataset and the derivatives.
+    The directory walks are cached in completion_cache.json.
+    """
+    out_dir = op.join(fmriprep_dir, "..")
+    cache_file = op.join(out_dir, "completion_cache.json")
+    cache = {}
+    if op.exists(cache_file):
+        with open(cache_file) as fo:
+            cache = json.load(fo)
 
-    # Get completed fmriprep
-    fmriprep_files = sorted(
-        glob(op.join(fmriprep_dir, "sub-*", session, "func", "sub-*_task-rest*_bold*"))
+    participant_ids_fn = op.join(dset, "participants.tsv")
+    participant_ids = pd.read_csv(participant_ids_fn, sep="\t", usecols=["participant_id"])[
+        "participant_id"
+    ]
+
+    trees = {"BIDS": (dset, RAW_PATTERN)}
+    trees.update(
+        {
+            "fMRIPrep": (fmriprep_dir, STAGES["fMRIPrep"]),
+            "Denoising": (denoising_dir, STAGES["Denoising"]),
+            "RSFC": (rsfc_dir, STAGES["RSFC"]),
+        }
+    )
+    # Walks are cached per stage and pattern, so editing a pattern discards its walk
+    found = {}
+    new_cache = {}
+    for stage, (root, pattern) in trees.items():
+        cache_key = f"{stage}:{pattern}"
+        found[stage] = scan_tree(root, pattern, cache.get(cache_key, {}))
+        new_cache[cache_key] = found[stage]
+    cache_key = f"MRIQC:{STAGES['MRIQC']}"
+    new_cache[cache_key], found["MRIQC"] = scan_flat(
+        mriqc_dir, STAGES["MRIQC"], cache.get(cache_key, {})
     )
-    fmriprep_ids_lst = [op.basename(x).split("_")[0] for x in fmriprep_files]
-    fmriprep_ids_lst = set(fmriprep_ids_lst)
 
-    # Get completed denoising
-    denoising_files = sorted(
-        glob(op.join(denoising_dir, "sub-*", session, "func", "sub-*_task-rest*_bold.nii.gz"))
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as fo:
+        json.dump(new_cache, fo)
+    os.replace(tmp_file, cache_file)
+
+    records = [
+        (subject, *run_key(file_name), stage)
+        for stage, subjects in found.items()
+        for subject, subject_files in subjects.items()
+        for file_name in subject_files["files"]
+    ]
+    runs_df = pd.DataFrame(records, columns=["participant_id", "session", "run", "stage"])
+    stages = list(STAGES)
+    run_status_df = (
+        pd.crosstab(
+            [runs_df["participant_id"], runs_df["session"], runs_df["run"]], runs_df["stage"]
+        )
+        .clip(upper=1)
+        .reindex(columns=["BIDS"] + stages, fill_value=0)
     )
-    denoising_ids_lst = [op.basename(x).split("_")[0] for x in denoising_files]
-    denoising_ids_lst = set(denoising_ids_lst)
+    run_status_df.columns.name = None
+
+    # Subject-level status in the requested session
+    session_df = run_status_df[run_status_df.index.get_level_values("session") == session]
+    status_df = (
+        session_df.groupby(level="participant_id")
+        .max()
+        .reindex(participant_ids, fill_value=0)
+        .rename_axis("participant_id")
+    )
+
+    for df in [run_status_df, status_df]:
+        missing = df[["BIDS"] + stages].eq(0)
+        df["blocking_stage"] = missing.idxmax(axis=1).where(missing.any(axis=1), "")
 
-    # Get completed rsfc
-    rsfc_files = sorted(
-        glob(op.join(rsfc_dir, "sub-*", session, "func", "sub-*_task-rest*_bucketREML+tlrc.BRIK"))
+    completion_df = status_df.reset_index()[
+        ["participant_id", "BIDS", "fMRIPrep", "MRIQC", "Denoising", "RSFC", "blocking_stage"]
+    ]
+    completion_df.to_csv(op.join(out_dir, "completion.tsv"), sep="\t", index=False)
+    run_status_df.reset_index().to_csv(
+        op.join(out_dir, "completion_runs.tsv"), sep="\t", index=False
     )
-    rsfc_ids_lst = [op.basename(x).split("_")[0] for x in rsfc_files]
-    rsfc_ids_lst = set(rsfc_ids_lst)
-
-    completion_df = pd.DataFrame()
-    mriqc_lst = []
-    fmriprep_lst = []
-    denoising_lst = []
-    rsfc_lst = []
-    for participant_id in participant_ids:
-        if participant_id in fmriprep_ids_lst:
-            fmriprep_lst.append(1)
-        else:
-            fmriprep_lst.append(0)
-        if participant_id in mriqc_ids_lst:
-            mriqc_lst.append(1)
-        else:
-            mriqc_lst.append(0)
-        if participant_id in denoising_ids_lst:
-            denoising_lst.append(1)
-        else:
-            denoising_lst.append(0)
-        if participant_id in rsfc_ids_lst:
-            rsfc_lst.append(1)
-        else:
-            rsfc_lst.append(0)
-
-    completion_df["participant_id"] = participant_ids
-    completion_df["fMRIPrep"] = fmriprep_lst
-    completion_df["MRIQC"] = mriqc_lst
-    completion_df["Denoising"] = denoising_lst
-    completion_df["RSFC"] = rsfc_lst
-    completion_df.to_csv(op.join(fmriprep_dir, "..", "completion.tsv"), sep="\t", index=False)
+    print(completion_df["blocking_stage"].replace("", "None").value_counts(), flush=True)
 
 
 def _main(argv=None):
@@ -4,6 +4,16 @@ import os.path as op
 import numpy as np
 import pandas as pd
 
+# Functional QC metrics of interest, and the tail where bad runs lie
+QC_METRICS = {
+    "efc": "upper",
+    "snr": "lower",
+    "fd_mean": "upper",
+    "tsnr": "lower",
+    "gsr_x": "upper",
+    "gsr_y": "upper",
+}
+
 
 def _get_parser():
     parser = argparse.ArgumentParser(description="Get outliers from QC metrics")
@@ -13,40 +23,139 @@ def _get_parser():
         required=True,
         help="Path to MRIQC derivatives",
     )
+    parser.add_argument(
+        "--rule",
+        dest="rule",
+        default="percentile",
+        choices=["percentile", "mad", "iqr"],
+        required=False,
+        help="Outlier rule: beyond a percentile, n_mad scaled MADs or iqr_k IQRs",
+    )
+    parser.add_argument(
+        "--percentile",
+        dest="percentile",
+        default=1,
+        type=float,
+        required=False,
+        help="Percentile of each tail flagged by the percentile rule",
+    )
+    parser.add_argument(
+        "--n_mad",
+        dest="n_mad",
+        default=3.5,
+        type=float,
+        required=False,
+        help="Scaled MADs from the median flagged by the mad rule",
+    )
+    parser.add_argument(
+        "--iqr_k",
+        dest="iqr_k",
+        default=1.5,
+        type=float,
+        required=False,
+        help="IQRs beyond the quartiles flagged by the iqr rule",
+    )
+    parser.add_argument(
+        "--participants_file",
+        dest="participants_file",
+        default=None,
+        required=False,
+        help="participants.tsv holding the group_by columns",
+    )
+    parser.add_argument(
+        "--group_by",
+        dest="group_by",
+        default=[],
+        required=False,
+        nargs="+",
+        help="participants_file columns (e.g., site) with thresholds of their own. Default: task",
+    )
     return parser
 
 
-def main(data):
-    # Adaptede from a function written by Michael Riedel
-    mriqc_group_df = pd.read_csv(op.join(data, "group_bold.tsv"), sep="\t")
+def qc_thresholds(values_df, keys, rule, percentile, n_mad, iqr_k):
+    """Lower and upper bounds of each group of keys, from the value column."""
+    grouped = values_df.groupby(keys, sort=False, dropna=False)["value"]
+    if rule == "percentile":
+        lower = grouped.quantile(percentile / 100)
+        upper = grouped.quantile(1 - percentile / 100)
+    elif rule == "mad":
+        median = grouped.median()
+        abs_dev = (values_df["value"] - grouped.transform("median")).abs()
+        # Scaled to the standard deviation of normally distributed values
+        mad = 1.4826 * abs_dev.groupby([values_df[x] for x in keys], dropna=False).median()
+        lower, upper = median - n_mad * mad, median + n_mad * mad
+    elif rule == "iqr":
+        q1 = grouped.quantile(0.25)
+        q3 = grouped.quantile(0.75)
+        lower, upper = q1 - iqr_k * (q3 - q1), q3 + iqr_k * (q3 - q1)
+    return pd.DataFrame({"lower": lower, "upper": upper})
 
-    # get task specific runs
-    mriqc_group_rest_df = mriqc_group_df[mriqc_group_df["bids_name"].str.contains("task-rest")]
 
-    # functional qc metrics of interest
-    qc_metrics = ["efc", "snr", "fd_mean", "tsnr", "gsr_x", "gsr_y"]
-    runs_exclude_df = pd.DataFrame()
-    for qc_metric in qc_metrics:
-        upper, lower = np.percentile(mriqc_group_rest_df[qc_metric].values, [99, 1])
+def main(data, rule, percentile, n_mad, iqr_k, participants_file, group_by):
+    """Flag the runs of every task with outlying QC metrics.
 
-        if qc_metric in ["efc", "fd_mean", "gsr_x", "gsr_y"]:
-            run2exclude = mriqc_group_rest_df.loc[mriqc_group_rest_df[qc_metric].values > upper]
-        elif qc_metric in ["snr", "tsnr"]:
-            run2exclude = mriqc_group_rest_df.loc[mriqc_group_rest_df[qc_metric].values < lower]
+    Thresholds are computed per task, group_by group and metric at once.
+    runs_to_exclude_reasons.tsv lists every flagged metric of every run, and
+    runs_to_exclude.tsv the flagged runs, as read by utils.OutlierRegistry.
+    """
+    # Adaptede from a function written by Michael Riedel
+    mriqc_group_df = pd.read_csv(
+        op.join(data, "group_bold.tsv"), sep="\t", usecols=["bids_name"] + list(QC_METRICS)
+    )
+    mriqc_group_df["task"] = mriqc_group_df["bids_name"].str.extract(r"task-([a-zA-Z0-9]+)")[0]
+    if group_by:
+        participants_df = pd.read_csv(
+            participants_file, sep="\t", usecols=["participant_id"] + group_by
+        )
+        mriqc_group_df["participant_id"] = mriqc_group_df["bids_name"].str.split("_").str[0]
+        mriqc_group_df = mriqc_group_df.merge(participants_df, on="participant_id", how="left")
 
-        runs_exclude_df = runs_exclude_df.append(run2exclude, ignore_index=True)
+    keys = ["task"] + group_by + ["metric"]
+    values_df = mriqc_group_df.melt(
+        id_vars=["bids_name", "task"] + group_by,
+        value_vars=list(QC_METRICS),
+        var_name="metric",
+        value_name="value",
+    )
+    thresholds_df = qc_thresholds(values_df, keys, rule, percentile, n_mad, iqr_k)
+    values_df = values_df.join(thresholds_df, on=keys)
+
+    upper_tail = values_df["metric"].map(QC_METRICS).eq("upper").to_numpy()
+    threshold = np.where(upper_tail, values_df["upper"], values_df["lower"])
+    value = values_df["value"].to_numpy()
+    exclude = np.where(upper_tail, value > threshold, value < threshold)
+    columns = ["bids_name", "task"] + group_by + ["metric", "value"]
+    runs_exclude_df = values_df.loc[exclude, columns]
+    runs_exclude_df["threshold"] = threshold[exclude]
+    runs_exclude_df["rule"] = rule
+    # Built as object Series, which stay strings when no run is flagged
+    comparison = pd.Series(
+        np.where(upper_tail[exclude], " > ", " < "), index=runs_exclude_df.index, dtype=object
+    )
+    runs_exclude_df["reason"] = (
+        runs_exclude_df["metric"].astype(object)
+        + comparison
+        + runs_exclude_df["threshold"].map(lambda x: f"{x:.4g}").astype(object)
+        + f" ({rule})"
+    )
 
-    runs_exclude_df = runs_exclude_df[["bids_name"]]
     # Remove 0 from run id and _bold suffix
     runs_exclude_df["bids_name"] = (
-        runs_exclude_df["bids_name"].str.replace("run-0", "run-").str.rstrip("_bold")
+        runs_exclude_df["bids_name"]
+        .str.replace("run-0", "run-", regex=False)
+        .str.replace(r"_bold$", "", regex=True)
     )
-    
-    
-    
+    runs_exclude_df = runs_exclude_df.sort_values(["bids_name", "metric"])
+    runs_exclude_df.to_csv(op.join(data, "runs_to_exclude_reasons.tsv"), sep="\t", index=False)
+
     # drop duplicates
-    runs_exclude_df = runs_exclude_df.drop_duplicates(subset=["bids_name"])
-    runs_exclude_df.to_csv(op.join(data, "runs_to_exclude.tsv"), sep="\t", index=False)
+    runs_exclude_df[["bids_name"]].drop_duplicates().to_csv(
+        op.join(data, "runs_to_exclude.tsv"), sep="\t", index=False
+    )
+    print(
+        runs_exclude_df.drop_duplicates(subset=["bids_name"]).groupby("task").size(), flush=True
+    )
 
 
 def _main(argv=None):
@@ -0,0 +1,264 @@
+import argparse
+import itertools
+import os
+import os.path as op
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+
+import numpy as np
+import pandas as pd
+
+sys.path.append("/home/data/abcd/code/abcd_fmriprep-analysis")
+from utils import enhance_censoring, fd_censoring, manufacturer_dummy_scans
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(description="Sweep FD censoring settings over a cohort")
+    parser.add_argument(
+        "--dset",
+        dest="dset",
+        required=True,
+        help="Path to BIDS directory",
+    )
+    parser.add_argument(
+        "--preproc_dir",
+        dest="preproc_dir",
+        required=True,
+        help="Path to fMRIPrep directory",
+    )
+    parser.add_argument(
+        "--out_dir",
+        dest="out_dir",
+        required=True,
+        help="Path to the output directory, also holding the FD cache",
+    )
+    parser.add_argument(
+        "--task",
+        dest="task",
+        default="rest",
+        required=False,
+        help="Task label",
+    )
+    parser.add_argument(
+        "--fd_thresh",
+        dest="fd_thresh",
+        default=[0.2, 0.25, 0.3, 0.35, 0.4, 0.5, 0.9],
+        type=float,
+        required=False,
+        nargs="+",
+        help="FD thresholds",
+    )
+    parser.add_argument(
+        "--n_before",
+        dest="n_before",
+        default=[1],
+        type=int,
+        required=False,
+        nargs="+",
+        help="Volumes censored before each high-motion volume",
+    )
+    parser.add_argument(
+        "--n_after",
+        dest="n_after",
+        default=[1, 2],
+        type=int,
+        required=False,
+        nargs="+",
+        help="Volumes censored after each high-motion volume",
+    )
+    parser.add_argument(
+        "--n_contig",
+        dest="n_contig",
+        default=[0],
+        type=int,
+        required=False,
+        nargs="+",
+        help="Minimum distance between censored volumes before the gap is censored too",
+    )
+    parser.add_argument(
+        "--min_volumes",
+        dest="min_volumes",
+        default=100,
+        type=int,
+        required=False,
+        help="Runs with fewer volumes left after censoring are excluded",
+    )
+    parser.add_argument(
+        "--min_nvol",
+        dest="min_nvol",
+        default=365,
+        type=int,
+        required=False,
+        help="Runs with fewer acquired volumes are excluded",
+    )
+    parser.add_argument(
+        "--group_by",
+        dest="group_by",
+        default=["Manufacturer"],
+        required=False,
+        nargs="+",
+        help="participants.tsv columns (e.g., site) to break the report down by",
+    )
+    parser.add_argument(
+        "--n_jobs",
+        dest="n_jobs",
+        default=4,
+        type=int,
+        required=False,
+        help="Threads used to read the confounds files",
+    )
+    return parser
+
+
+def read_fd(confounds_file):
+    return pd.read_csv(confounds_file, sep="\t", usecols=["framewise_displacement"])[
+        "framewise_displacement"
+    ].to_numpy(dtype=np.float32)
+
+
+def load_fd(confounds_files, cache_file, n_jobs):
+    """FD of every run as a NaN-padded (n_runs, max_volumes) array, with run lengths.
+
+    The FD column of each confounds file is read once and kept in cache_file;
+    later calls only read the files that are new or changed since (by mtime).
+    """
+    mtimes = np.array([os.stat(x).st_mtime_ns for x in confounds_files], dtype=np.int64)
+    cached = {}
+    if op.exists(cache_file):
+        with np.load(cache_file) as cache:
+            for confounds_file, mtime, length, fd in zip(
+                cache["files"], cache["mtimes"], cache["lengths"], cache["fd"]
+            ):
+                cached[str(confounds_file)] = (mtime, fd[:length])
+
+    to_read = [
+        x for x, mtime in zip(confounds_files, mtimes) if cached.get(x, (None,))[0] != mtime
+    ]
+    print(f"Reading FD from {len(to_read)}/{len(confounds_files)} confounds files", flush=True)
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        new_fd = dict(zip(to_read, executor.map(read_fd, to_read)))
+
+    fd_list = [new_fd[x] if x in new_fd else cached[x][1] for x in confounds_files]
+    lengths = np.array([len(x) for x in fd_list], dtype=int)
+    fd = np.full((len(fd_list), lengths.max(initial=0)), np.nan, dtype=np.float32)
+    for i, run_fd in enumerate(fd_list):
+        fd[i, : len(run_fd)] = run_fd
+
+    if len(to_read) > 0 or len(cached) != len(confounds_files):
+        tmp_file = cache_file.replace(".npz", f"_{os.getpid()}.tmp.npz")
+        np.savez(
+            tmp_file, files=np.array(confounds_files), mtimes=mtimes, lengths=lengths, fd=fd
+        )
+        os.replace(tmp_file, cache_file)
+    return fd, lengths
+
+
+def main(
+    dset,
+    preproc_dir,
+    out_dir,
+    task,
+    fd_thresh,
+    n_before,
+    n_after,
+    n_contig,
+    min_volumes,
+    min_nvol,
+    group_by,
+    n_jobs,
+):
+    """Report the volumes and runs left by every combination of censoring settings.
+
+    Mirrors the censoring of denoising.run_3dtproject (fd_censoring, then
+    enhance_censoring, then dropping the dummy scans, and the min_volumes and
+    min_nvol exclusion rules) on all runs at once, for every setting. Runs
+    without a known Manufacturer, which denoising.py does not process, are
+    listed in task-<task>_desc-nomanufacturer_runs.tsv and left out.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    confounds_files = sorted(
+        glob(
+            op.join(preproc_dir, "sub-*", "**", f"*task-{task}*_desc-confounds_timeseries.tsv"),
+            recursive=True,
+        )
+    )
+    fd, lengths = load_fd(
+        confounds_files, op.join(out_dir, f"task-{task}_desc-FD_cache.npz"), n_jobs
+    )
+
+    runs_df = pd.DataFrame(
+        {
+            "bids_name": [op.basename(x).split("_desc-confounds")[0] for x in confounds_files],
+            "participant_id": [op.basename(x).split("_")[0] for x in confounds_files],
+            "nvol": lengths,
+        }
+    )
+    participants_df = pd.read_csv(
+        op.join(dset, "participants.tsv"),
+        sep="\t",
+        usecols=lambda x: x in set(["participant_id", "Manufacturer"] + group_by),
+    )
+    runs_df = runs_df.merge(participants_df, on="participant_id", how="left")
+    dummy_scans = runs_df["Manufacturer"].map(manufacturer_dummy_scans)
+    unknown = dummy_scans.isna().to_numpy()
+    if unknown.any():
+        unknown_file = op.join(out_dir, f"task-{task}_desc-nomanufacturer_runs.tsv")
+        runs_df.loc[unknown, ["bids_name", "participant_id", "Manufacturer"]].to_csv(
+            unknown_file, sep="\t", index=False
+        )
+        print(
+            f"Leaving out {unknown.sum()} runs without a known Manufacturer, see {unknown_file}",
+            flush=True,
+        )
+        runs_df = runs_df[~unknown].reset_index(drop=True)
+        fd, lengths = fd[~unknown], lengths[~unknown]
+    dummy_scans = dummy_scans[~unknown].to_numpy(dtype=int)
+
+    # Volumes that count once the dummy scans (and the NaN padding) are dropped
+    vols = np.arange(fd.shape[1])
+    valid = (vols >= dummy_scans[:, None]) & (vols < lengths[:, None])
+
+    results = []
+    for thresh, before, after, contig in itertools.product(fd_thresh, n_before, n_after, n_contig):
+        censor = enhance_censoring(
+            fd_censoring(fd, thresh), n_contig=contig, n_before=before, n_after=after
+        )
+        setting_df = runs_df[["participant_id"] + group_by].copy()
+        setting_df["kept_volumes"] = np.count_nonzero((censor == 1) & valid, axis=1)
+        setting_df["excluded"] = (setting_df["kept_volumes"] < min_volumes) | (
+            runs_df["nvol"] < min_nvol
+        )
+        setting_df["fd_thresh"] = thresh
+        setting_df["n_before"] = before
+        setting_df["n_after"] = after
+        setting_df["n_contig"] = contig
+        results.append(setting_df)
+    results_df = pd.concat(results, ignore_index=True)
+
+    settings = ["fd_thresh", "n_before", "n_after", "n_contig"]
+    for report_name, keys in [("all", settings), ("group", settings + group_by)]:
+        grouped = results_df.groupby(keys, dropna=False)
+        report_df = grouped.agg(
+            n_runs=("excluded", "size"),
+            n_excluded_runs=("excluded", "sum"),
+            surviving_volumes=("kept_volumes", "sum"),
+            median_kept_volumes=("kept_volumes", "median"),
+        )
+        report_df["pct_excluded_runs"] = 100 * report_df["n_excluded_runs"] / report_df["n_runs"]
+        kept_df = results_df[~results_df["excluded"]]
+        n_subjects = kept_df.groupby(keys, dropna=False)["participant_id"].nunique()
+        report_df["n_subjects"] = n_subjects.reindex(report_df.index, fill_value=0)
+        report_file = op.join(out_dir, f"task-{task}_desc-{report_name}_censoring.tsv")
+        report_df.reset_index().to_csv(report_file, sep="\t", index=False)
+        print(f"Report written to {report_file}", flush=True)
+
+
+def _main(argv=None):
+    option = _get_parser().parse_args(argv)
+    kwargs = vars(option)
+    main(**kwargs)
+
+
+if __name__ == "__main__":
+    _main()
@@ -1,18 +1,16 @@
 import os.path as op
+import sys
 
-import pandas as pd
+sys.path.append("/home/data/abcd/code/abcd_fmriprep-analysis")
+from utils import OutlierRegistry
 
 mriqc_dir = "/home/data/abcd/abcd-hispanic-via/dset/derivatives/mriqc-0.16.1"
-runs_to_exclude_qcfc_df = pd.read_csv(op.join(mriqc_dir, "runs_to_exclude_qcfc.tsv"), sep="\t")
-runs_to_exclude_qcfc = runs_to_exclude_qcfc_df["bids_name"].tolist()
+runs_to_exclude_qcfc = OutlierRegistry(op.join(mriqc_dir, "runs_to_exclude_qcfc.tsv"))
 
-runs_to_exclude_FD_df = pd.read_csv(op.join(mriqc_dir, "runs_to_exclude.tsv"), sep="\t")
-runs_to_exclude_FD = runs_to_exclude_FD_df["bids_name"].tolist()
+# Fold the shards appended by the denoising and RSFC jobs into runs_to_exclude.tsv
+runs_to_exclude_FD = OutlierRegistry(op.join(mriqc_dir, "runs_to_exclude.tsv"))
+runs_to_exclude_FD.compact()
 
-new_list = runs_to_exclude_qcfc + runs_to_exclude_FD
-new_list = list(set(new_list))
-
-new_df = pd.DataFrame()
-new_df["bids_name"] = new_list
-
-new_df.to_csv(op.join(mriqc_dir, "runs_to_exclude_qcfc.tsv"), sep="\t", index=False)
+for bids_name in runs_to_exclude_FD.names:
+    runs_to_exclude_qcfc.add(bids_name)
+runs_to_exclude_qcfc.compact()
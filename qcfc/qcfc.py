@@ -15,7 +15,13 @@ from scipy.stats import ks_2samp, normaltest
 from sklearn.neighbors import KernelDensity
 
 sys.path.append("/home/data/abcd/code/abcd_fmriprep-analysis")
-from utils import get_nvol
+from utils import (
+    OutlierRegistry,
+    RunIndex,
+    get_kept_volumes,
+    get_nvol,
+    manufacturer_dummy_scans,
+)
 
 sns.set_style("white")
 
@@ -86,6 +92,13 @@ def _get_parser():
         required=True,
         help="CPUs",
     )
+    parser.add_argument(
+        "--run_index",
+        dest="run_index",
+        default=None,
+        required=False,
+        help="Run index (see run_index.py). Default: <dset>/derivatives/run_index.tsv",
+    )
     return parser
 
 
@@ -236,6 +249,7 @@ def main(
     qc_thresh,
     desc_list,
     n_jobs,
+    run_index,
 ):
     """Run QCFC workflow on a given dataset."""
     # Taken from Taylor's pipeline
@@ -245,6 +259,10 @@ def main(
 
     participant_ids_fn = op.join(dset, "participants.tsv")
     participant_ids_df = pd.read_csv(participant_ids_fn, sep="\t")
+    manufacturers = participant_ids_df.set_index("participant_id")["Manufacturer"]
+    if run_index is None:
+        run_index = op.join(dset, "derivatives", "run_index.tsv")
+    run_index = RunIndex.load(run_index)
 
     if sessions[0] is None:
         temp_ses = glob(op.join(clean_dir, "*", "ses-*"))
@@ -278,10 +296,8 @@ def main(
 
     # TODO: Use the exlcue from MRIQC here !!!!!!!!!!!!!!!!!!!!!!!!!!
     # runs_to_exclude_df = pd.read_csv(op.join(mriqc_dir, "runs_to_exclude_qcfc.tsv"), sep="\t")
-    runs_to_exclude_df = pd.read_csv(op.join(mriqc_dir, "runs_to_exclude_qcfc.tsv"), sep="\t")
-    runs_to_exclude = runs_to_exclude_df["bids_name"].tolist()
-    prefixes_tpl = tuple(runs_to_exclude)
-    img_clean_files = [x for x in img_files if not op.basename(x).startswith(prefixes_tpl)]
+    registry = OutlierRegistry(op.join(mriqc_dir, "runs_to_exclude_qcfc.tsv"))
+    img_clean_files = registry.filter(img_files)
 
     censored_qcs = []
     for img_clean_file in img_clean_files:
@@ -304,27 +320,19 @@ def main(
         assert len(confounds_files) == 1
         confounds_file = confounds_files[0]
 
-        censor_files = glob(
-            op.join(nuis_subj_dir, f"{prefix}*_space-{space}*_censoring{qc_thresh}.1D")
-        )
-        assert len(censor_files) == 1
-        tr_censor = pd.read_csv(censor_files[0], header=None)
-        tr_censor_idx = tr_censor.index[tr_censor[0] == 0].tolist()
+        clean_prefix = img_clean_name.split("desc-")[0].rstrip("_")
+        tr_keep = get_kept_volumes(nuis_subj_dir, clean_prefix, qc_thresh)
 
         confounds_df = pd.read_csv(confounds_file, sep="\t")
         qc = confounds_df["framewise_displacement"].values
         qc = np.nan_to_num(qc, 0)
 
-        # Get dummy_scans from paticipants.tsv
-        manufacturer = participant_ids_df.loc[
-            participant_ids_df["participant_id"] == subject, "Manufacturer"
-        ].values[0]
-        if manufacturer == "GE":
-            dummy_scans = 5
-        elif (manufacturer == "Siemens") or (manufacturer == "Philips"):
-            dummy_scans = 8
-        censored_qc = np.delete(qc[dummy_scans:], tr_censor_idx)
-        assert get_nvol(img_clean_file) == len(censored_qc)
+        # Get dummy_scans from the run index, or else from paticipants.tsv
+        dummy_scans = run_index.dummy_scans(
+            img_clean_file, manufacturer_dummy_scans(manufacturers[subject])
+        )
+        censored_qc = qc[dummy_scans:][tr_keep]
+        assert get_nvol(img_clean_file, run_index) == len(censored_qc)
 
         censored_qcs.append(censored_qc)
 
@@ -0,0 +1,83 @@
+import argparse
+import os.path as op
+from glob import glob
+
+from utils import RunIndex
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(description="Build or update the dataset run index")
+    parser.add_argument(
+        "--dset",
+        dest="dset",
+        required=True,
+        help="Path to BIDS directory",
+    )
+    parser.add_argument(
+        "--dirs",
+        dest="dirs",
+        default=None,
+        required=False,
+        nargs="+",
+        help="Trees to index (e.g., fMRIPrep, denoising, RSFC). Default: the raw dataset",
+    )
+    parser.add_argument(
+        "--patterns",
+        dest="patterns",
+        default=["*_bold.nii.gz", "*_bucket.nii.gz", "*_mask.nii.gz"],
+        required=False,
+        nargs="+",
+        help="File name patterns of the images to index",
+    )
+    parser.add_argument(
+        "--index_file",
+        dest="index_file",
+        default=None,
+        required=False,
+        help="Path to the index. Default: <dset>/derivatives/run_index.tsv",
+    )
+    parser.add_argument(
+        "--n_jobs",
+        dest="n_jobs",
+        default=8,
+        type=int,
+        required=False,
+        help="Threads used to read the image headers",
+    )
+    return parser
+
+
+def main(dset, dirs, patterns, index_file, n_jobs):
+    """Index the runs of a dataset, reading only the images that are new or changed."""
+    if dirs is None:
+        dirs = [dset]
+    if index_file is None:
+        index_file = op.join(dset, "derivatives", "run_index.tsv")
+
+    nifti_files = sorted(
+        set(
+            x
+            for tree in dirs
+            for pattern in patterns
+            for x in glob(op.join(tree, "sub-*", "**", "func", pattern), recursive=True)
+        )
+    )
+    participants_file = op.join(dset, "participants.tsv")
+    run_index = RunIndex(index_file)
+    n_read = run_index.update(
+        nifti_files,
+        bids_dir=dset,
+        participants_file=participants_file if op.exists(participants_file) else None,
+        n_jobs=n_jobs,
+    )
+    print(f"{n_read} images updated, {len(run_index)} images in {index_file}", flush=True)
+
+
+def _main(argv=None):
+    option = _get_parser().parse_args(argv)
+    kwargs = vars(option)
+    main(**kwargs)
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,35 @@
+import importlib.util
+import os.path as op
+
+import pandas as pd
+import pytest
+
+SCRIPT = op.join(op.dirname(op.dirname(op.abspath(__file__))), "mriqc", "mriqc-group.py")
+
+
+def _load_mriqc_group():
+    spec = importlib.util.spec_from_file_location("mriqc_group", SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.mark.parametrize("rule", ["percentile", "mad", "iqr"])
+def test_no_outliers(tmp_path, rule):
+    """Identical runs flag nothing, and both tables are still written."""
+    mriqc_group = _load_mriqc_group()
+    group_df = pd.DataFrame(
+        {"bids_name": [f"sub-{i:02d}_task-rest_run-01_bold" for i in range(20)]}
+    )
+    for metric in mriqc_group.QC_METRICS:
+        group_df[metric] = 1.0
+    group_df.to_csv(tmp_path / "group_bold.tsv", sep="\t", index=False)
+
+    mriqc_group.main(str(tmp_path), rule, 1, 3.5, 1.5, None, [])
+
+    reasons_df = pd.read_csv(tmp_path / "runs_to_exclude_reasons.tsv", sep="\t")
+    runs_df = pd.read_csv(tmp_path / "runs_to_exclude.tsv", sep="\t")
+    assert len(reasons_df) == 0
+    assert "reason" in reasons_df.columns
+    assert list(runs_df.columns) == ["bids_name"]
+    assert len(runs_df) == 0
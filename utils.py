@@ -1,7 +1,14 @@
+import fcntl
+import hashlib
 import json as js
 import os
 import os.path as op
+import socket
 import subprocess
+import time
+from contextlib import contextmanager
+from glob import glob
+from shutil import copyfile, rmtree
 
 import numpy as np
 import pandas as pd
@@ -26,115 +33,1215 @@ def run_command(command, env=None):
     return line
 
 
-def get_acompcor(regressfile, out_file, trs_to_delete):
-    df_in = pd.read_csv(regressfile, sep="\t")
-    with open("{0}.json".format(regressfile.replace(".tsv", ""))) as json_file:
-        data = js.load(json_file)
-        acompcors = sorted([x for x in data.keys() if "a_comp_cor" in x])
-        # for muschelli 2014
-        acompcor_list_CSF = [x for x in acompcors if data[x]["Mask"] == "CSF"]
-        acompcor_list_CSF = acompcor_list_CSF[0:3]
-        acompcor_list_WM = [x for x in acompcors if data[x]["Mask"] == "WM"]
-        acompcor_list_WM = acompcor_list_WM[0:3]
-        acompcor_list = []
-        acompcor_list.extend(acompcor_list_CSF)
-        acompcor_list.extend(acompcor_list_WM)
-
-    df_out = df_in[acompcor_list]
-    df_out = df_out.replace("n/a", 0)
-    df_out = df_out.drop([i for i in range(trs_to_delete)])
-    df_out.to_csv(out_file, sep="\t", header=False, index=False)
-
-
-def fd_censoring(tmp_file, fd_thresh):
-    df_in = pd.read_csv(tmp_file, sep="\t")
-    fd = df_in["framewise_displacement"]
-    fd = fd[
-        1:,
-    ]
-    fd_cens = np.ones(len(fd.index) + 1)
-    fd_list = []
-    for i, tmp_fd in enumerate(fd):
-        if float(tmp_fd) > fd_thresh:
-            fd_list.append(i + 1)
-    fd_cens[fd_list] = 0
+def set_command_log(log_dir):
+    """Log the run_tool calls of this process and its children to log_dir.
+
+    Each process appends to its own ``commands_<host>_<pid>.jsonl`` file.
+    """
+    os.environ["COMMAND_LOG"] = log_dir
+
+
+# Seconds after which run_tool kills a tool, unless set by set_command_timeout
+COMMAND_TIMEOUT = 12 * 3600
+
+
+def set_command_timeout(timeout):
+    """Kill the run_tool calls of this process and its children after timeout seconds.
+
+    None keeps the default, COMMAND_TIMEOUT.
+    """
+    if timeout is not None:
+        os.environ["COMMAND_TIMEOUT"] = str(float(timeout))
+
+
+def run_tool(args, timeout=None, cwd=None, stdin_file=None, stdout_file=None):
+    """Run a command-line tool from an argument list, without a shell.
+
+    Unlike ``os.system``, a nonzero exit status raises CalledProcessError, and
+    the tool is killed after timeout seconds (by default, the value set by
+    ``set_command_timeout``, i.e. the COMMAND_TIMEOUT variable, or 12 hours),
+    raising TimeoutExpired. The wall time, peak RSS (from the child's rusage)
+    and exit status are appended as one JSON line to the command log set by
+    ``set_command_log`` (the COMMAND_LOG variable).
+    """
+    import threading
+
+    if timeout is None:
+        timeout = float(os.environ.get("COMMAND_TIMEOUT", COMMAND_TIMEOUT))
+    args = [str(arg) for arg in args]
+    print(f"\t\t\t{' '.join(args)}", flush=True)
+    stdin = open(stdin_file, "r") if stdin_file else None
+    stdout = open(stdout_file, "w") if stdout_file else None
+    start = time.time()
+    try:
+        process = subprocess.Popen(args, cwd=cwd, stdin=stdin, stdout=stdout)
+        timed_out = threading.Event()
+
+        def _kill():
+            timed_out.set()
+            process.kill()
+
+        timer = threading.Timer(timeout, _kill)
+        timer.start()
+        _, status, rusage = os.wait4(process.pid, 0)
+        timer.cancel()
+    finally:
+        for fo in [stdin, stdout]:
+            if fo is not None:
+                fo.close()
+    if os.WIFSIGNALED(status):
+        returncode = -os.WTERMSIG(status)
+    else:
+        returncode = os.WEXITSTATUS(status)
+    # The child was reaped by wait4; keep Popen from waiting on it again
+    process.returncode = returncode
+
+    log_dir = os.environ.get("COMMAND_LOG")
+    if log_dir is not None:
+        record = {
+            "tool": op.basename(args[0]),
+            "args": args,
+            "returncode": returncode,
+            "timed_out": timed_out.is_set(),
+            "wall_time": round(time.time() - start, 3),
+            "max_rss_mb": round(rusage.ru_maxrss / 1024, 1),
+            "user_time": round(rusage.ru_utime, 3),
+            "system_time": round(rusage.ru_stime, 3),
+            "start": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(start)),
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+        }
+        os.makedirs(log_dir, exist_ok=True)
+        log_file = op.join(log_dir, f"commands_{socket.gethostname()}_{os.getpid()}.jsonl")
+        fd = os.open(log_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o664)
+        try:
+            os.write(fd, f"{js.dumps(record)}\n".encode("utf-8"))
+        finally:
+            os.close(fd)
+
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(args, timeout)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, args)
+
+
+MOTION_LABELS = [
+    "trans_x",
+    "trans_x_derivative1",
+    "trans_y",
+    "trans_y_derivative1",
+    "trans_z",
+    "trans_z_derivative1",
+    "rot_x",
+    "rot_x_derivative1",
+    "rot_y",
+    "rot_y_derivative1",
+    "rot_z",
+    "rot_z_derivative1",
+]
+
+
+class Confounds:
+    """fMRIPrep confounds table parsed once and shared by all regressor builders.
+
+    Only the columns needed downstream are kept, in a column-major float32 array
+    ordered as [motion + derivatives, aCompCor CSF, aCompCor WM, global signal, FD].
+    Every group is a contiguous (or regularly strided) block, so the accessors
+    return views into the same buffer instead of copies.
+
+    Parameters
+    ----------
+    confounds_file : str
+        Path to the ``*_desc-confounds_timeseries.tsv`` file.
+    groups : tuple of str
+        Column groups to load, any of "motion", "acompcor", "gsr" and "fd".
+        The JSON sidecar is only read when "acompcor" is requested.
+    n_compcor : int
+        Number of CSF and WM aCompCor components to keep (Muschelli 2014).
+    """
+
+    def __init__(self, confounds_file, groups=("motion", "acompcor", "gsr", "fd"), n_compcor=5):
+        self.confounds_file = confounds_file
+        self.acompcor_labels = []
+        if "acompcor" in groups:
+            with open(confounds_file.replace(".tsv", ".json")) as json_file:
+                data = js.load(json_file)
+            c_comp_cor = sorted([x for x in data.keys() if "c_comp_cor" in x])
+            w_comp_cor = sorted([x for x in data.keys() if "w_comp_cor" in x])
+            acompcor_list_CSF = [x for x in c_comp_cor if data[x]["Mask"] == "CSF"]
+            acompcor_list_WM = [x for x in w_comp_cor if data[x]["Mask"] == "WM"]
+            self.acompcor_labels = acompcor_list_CSF[0:n_compcor] + acompcor_list_WM[0:n_compcor]
+
+        labels = []
+        self._slices = {}
+        for group, group_labels in [
+            ("motion", MOTION_LABELS),
+            ("acompcor", self.acompcor_labels),
+            ("gsr", ["global_signal"]),
+            ("fd", ["framewise_displacement"]),
+        ]:
+            if group in groups:
+                self._slices[group] = slice(len(labels), len(labels) + len(group_labels))
+                labels.extend(group_labels)
+        self.labels = labels
+
+        confounds_df = pd.read_csv(
+            confounds_file, sep="\t", usecols=labels, dtype=np.float32, na_values="n/a"
+        )
+        self.data = np.asfortranarray(confounds_df[labels].to_numpy(dtype=np.float32))
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def _group(self, group):
+        if group not in self._slices:
+            raise ValueError(f"{group} was not loaded from {self.confounds_file}")
+        return self.data[:, self._slices[group]]
+
+    def motion(self, derivatives=None):
+        """Motion parameters, with their first temporal derivatives if requested."""
+        motion = self._group("motion")
+        return motion if derivatives else motion[:, ::2]
+
+    @property
+    def acompcor(self):
+        return self._group("acompcor")
+
+    @property
+    def gsr(self):
+        return self._group("gsr")[:, 0]
+
+    @property
+    def fd(self):
+        return self._group("fd")[:, 0]
+
+    @property
+    def nuisance(self):
+        """Motion + derivatives, aCompCor and GSR as a single (T, K) view."""
+        for group in ["motion", "acompcor", "gsr"]:
+            self._group(group)
+        return self.data[:, self._slices["motion"].start : self._slices["gsr"].stop]
+
+
+def _as_confounds(confounds, groups):
+    if isinstance(confounds, Confounds):
+        return confounds
+    return Confounds(confounds, groups=groups)
+
+
+class OutlierRegistry:
+    """Append-only registry of runs to exclude, safe for concurrent SLURM array tasks.
+
+    The base table (e.g., ``runs_to_exclude.tsv`` written by ``mriqc-group.py``) is
+    never rewritten by the workers. Each process appends one line per new run to
+    its own shard in ``<base>.d/``, with a single ``O_APPEND`` write, so
+    concurrent tasks cannot lose each other's updates. Readers merge the base
+    table and all shards into a set once, and ``compact`` folds the shards back
+    into the base table through an atomic rename. Appends hold a shared
+    ``fcntl`` lock on ``<base>.d/.lock`` and ``compact`` an exclusive one while
+    it claims and reads the shards, so no line is written to a shard after
+    it was read.
+
+    Parameters
+    ----------
+    registry_file : str
+        Path to the base TSV file, with a ``bids_name`` column.
+    """
+
+    def __init__(self, registry_file):
+        self.registry_file = registry_file
+        self.shard_dir = "{}.d".format(op.splitext(registry_file)[0])
+        self.shard_file = op.join(
+            self.shard_dir, "{}_{}.tsv".format(socket.gethostname(), os.getpid())
+        )
+        self._names = None
+
+    @staticmethod
+    def _read(tsv_file):
+        with open(tsv_file, "r") as fo:
+            lines = fo.read().splitlines()
+        return {line.strip() for line in lines if line.strip() not in ["", "bids_name"]}
+
+    @contextmanager
+    def _lock(self, operation):
+        os.makedirs(self.shard_dir, exist_ok=True)
+        fd = os.open(op.join(self.shard_dir, ".lock"), os.O_RDWR | os.O_CREAT, 0o664)
+        try:
+            fcntl.flock(fd, operation)
+            yield
+        finally:
+            # Closing the descriptor releases the lock
+            os.close(fd)
+
+    def _shard_files(self):
+        if not op.isdir(self.shard_dir):
+            return []
+        return sorted(
+            op.join(self.shard_dir, x) for x in os.listdir(self.shard_dir) if x.endswith(".tsv")
+        )
+
+    @property
+    def names(self):
+        """Set of excluded run names from the base table and every shard."""
+        if self._names is None:
+            names = set()
+            if op.exists(self.registry_file):
+                names.update(self._read(self.registry_file))
+            for shard_file in self._shard_files():
+                names.update(self._read(shard_file))
+            self._names = names
+        return self._names
+
+    def __contains__(self, bids_name):
+        return bids_name in self.names
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, bids_name):
+        """Register a run. Return False if it was already excluded."""
+        if bids_name in self.names:
+            return False
+        with self._lock(fcntl.LOCK_SH):
+            fd = os.open(self.shard_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o664)
+            try:
+                os.write(fd, f"{bids_name}\n".encode("utf-8"))
+            finally:
+                os.close(fd)
+        self.names.add(bids_name)
+        return True
+
+    def is_excluded(self, file_name):
+        """Check if any leading BIDS entities of a file name were registered.
+
+        Equivalent to the former ``op.basename(x).startswith(prefixes_tpl)`` scan,
+        but only matches whole entities (run-1 no longer excludes run-10).
+        """
+        entities = op.basename(file_name).split("_")
+        return any("_".join(entities[: i + 1]) in self.names for i in range(len(entities)))
+
+    def filter(self, files):
+        """Drop the files that belong to excluded runs."""
+        return [x for x in files if not self.is_excluded(x)]
+
+    def compact(self):
+        """Merge the shards into the base table and remove them."""
+        names = set()
+        if op.exists(self.registry_file):
+            names.update(self._read(self.registry_file))
+        claimed_files = []
+        # No worker holds a shard open while the shards are claimed and read
+        with self._lock(fcntl.LOCK_EX):
+            for shard_file in self._shard_files():
+                # Claim the shard first so lines appended after this point go to a new shard
+                claimed_file = f"{shard_file}.compact"
+                try:
+                    os.replace(shard_file, claimed_file)
+                except FileNotFoundError:
+                    continue
+                names.update(self._read(claimed_file))
+                claimed_files.append(claimed_file)
+
+        tmp_file = f"{self.registry_file}.{socket.gethostname()}_{os.getpid()}.tmp"
+        with open(tmp_file, "w") as fo:
+            fo.write("bids_name\n")
+            fo.writelines(f"{name}\n" for name in sorted(names))
+        os.replace(tmp_file, self.registry_file)
+        for claimed_file in claimed_files:
+            os.remove(claimed_file)
+        self._names = names
+
+
+class ROIExtractor:
+    """Average an image within many ROIs with a single sparse matrix product.
+
+    ROIs and atlases on one voxel grid are stacked into a sparse
+    (n_rois, n_voxels) averaging matrix restricted to the voxels that belong to
+    any ROI, so each 3D/4D image only has to be read once, whatever the
+    number of ROIs. Binary masks are averaged over their nonzero voxels, as
+    ``3dmaskave`` does; atlases contribute one ROI per nonzero label.
+    """
+
+    def __init__(self):
+        self.labels = []
+        self._rows = []
+        self._voxels = []
+        self._weights = []
+        self._matrix = None
+
+    def _add(self, roi_data, name, atlas, labels=None):
+        roi_data = np.asarray(roi_data).ravel()
+        voxels = np.flatnonzero(roi_data)
+        if not atlas:
+            roi_labels, inverse = [1], np.zeros(len(voxels), dtype=int)
+        elif labels is None:
+            roi_labels, inverse = np.unique(roi_data[voxels], return_inverse=True)
+        else:
+            # Keep the requested label order; voxels with other labels are ignored
+            roi_labels = np.asarray(labels)
+            order = np.argsort(roi_labels)
+            pos = np.searchsorted(roi_labels[order], roi_data[voxels])
+            pos = np.clip(pos, 0, len(roi_labels) - 1)
+            valid = roi_labels[order][pos] == roi_data[voxels]
+            voxels, inverse = voxels[valid], order[pos[valid]]
+        counts = np.bincount(inverse, minlength=len(roi_labels))
+        self._rows.append(len(self.labels) + inverse)
+        self._voxels.append(voxels)
+        self._weights.append(1.0 / counts[inverse])
+        self.labels.extend((name, label) for label in roi_labels)
+        self._matrix = None
+
+    def add_mask(self, mask_data, name=None):
+        """Add one ROI made of the nonzero voxels of mask_data."""
+        self._add(mask_data, name, atlas=False)
+
+    def add_atlas(self, atlas_data, name=None, labels=None):
+        """Add one ROI per nonzero label of atlas_data.
+
+        With labels, one ROI per requested label in that order; labels without
+        voxels (e.g., outside the brain mask) average to 0.
+        """
+        self._add(atlas_data, name, atlas=True, labels=labels)
+
+    def _build(self):
+        from scipy import sparse
+
+        voxels = np.concatenate(self._voxels)
+        self.voxels = np.unique(voxels)
+        self._matrix = sparse.csr_matrix(
+            (
+                np.concatenate(self._weights),
+                (np.concatenate(self._rows), np.searchsorted(self.voxels, voxels)),
+            ),
+            shape=(len(self.labels), len(self.voxels)),
+        )
+
+    def transform(self, data):
+        """Return the (n_rois, n_volumes) ROI means of a 3D or 4D array."""
+        if self._matrix is None:
+            self._build()
+        data = np.asarray(data)
+        n_vols = data.shape[3] if data.ndim == 4 else 1
+        roi_data = data.reshape(-1, n_vols)[self.voxels]
+        return np.asarray(self._matrix @ roi_data)
+
+
+class ConnectomeStore:
+    """Append-only (n_runs, n_edges) store of ROI-to-ROI connectomes for one atlas.
+
+    The upper triangle (without the diagonal) of each run's Fisher z matrix is
+    appended as one float32 row of a raw ``<prefix>_edges.f32`` file, and its
+    BIDS name as one line of ``<prefix>_index.tsv``. Rows are written before
+    the index, and only the rows listed in the index are ever read, so an
+    interrupted append leaves a readable store and appending never rewrites
+    previous runs. ``edges`` memory-maps the whole array. A store has a single
+    writer (the group aggregation job); any number of readers.
+
+    Parameters
+    ----------
+    store_dir : str
+        Directory holding the store files.
+    atlas : str
+        Atlas name, used as the file prefix ``desc-<atlas>``.
+    """
+
+    def __init__(self, store_dir, atlas):
+        self.prefix = op.join(store_dir, f"desc-{atlas}")
+        self.edges_file = f"{self.prefix}_edges.f32"
+        self.index_file = f"{self.prefix}_index.tsv"
+        self.labels_file = f"{self.prefix}_labels.tsv"
+        self._index = None
+        self._names = None
+        self._labels = None
+
+    @property
+    def index(self):
+        """List of the BIDS names of the stored runs, in row order."""
+        if self._index is None:
+            self._index = []
+            if op.exists(self.index_file):
+                with open(self.index_file, "r") as fo:
+                    self._index = [x for x in fo.read().splitlines()[1:] if x != ""]
+        return self._index
+
+    @property
+    def labels(self):
+        """DataFrame with the value and label of every ROI, or None for an empty store."""
+        if (self._labels is None) and op.exists(self.labels_file):
+            self._labels = pd.read_csv(self.labels_file, sep="\t")
+        return self._labels
+
+    @property
+    def n_edges(self):
+        n_rois = len(self.labels)
+        return n_rois * (n_rois - 1) // 2
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, bids_name):
+        if self._names is None:
+            self._names = set(self.index)
+        return bids_name in self._names
+
+    @property
+    def edges(self):
+        """Read-only memory map of the (n_runs, n_edges) Fisher z values."""
+        if len(self) == 0:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.memmap(
+            self.edges_file, dtype=np.float32, mode="r", shape=(len(self), self.n_edges)
+        )
+
+    def triu_indices(self):
+        """Row and column ROI indices of each edge."""
+        return np.triu_indices(len(self.labels), k=1)
+
+    def append(self, bids_names, z_matrices, values, labels):
+        """Append the connectomes of new runs, skipping the runs already stored."""
+        if self.labels is None:
+            os.makedirs(op.dirname(self.prefix), exist_ok=True)
+            pd.DataFrame({"value": values, "label": labels}).to_csv(
+                self.labels_file, sep="\t", index=False
+            )
+            self._labels = None
+        assert np.array_equal(self.labels["value"].to_numpy(), np.asarray(values))
+
+        rows, new_names = [], []
+        triu = self.triu_indices()
+        for bids_name, z_matrix in zip(bids_names, z_matrices):
+            if (bids_name in self) or (bids_name in new_names):
+                continue
+            rows.append(np.asarray(z_matrix, dtype=np.float32)[triu])
+            new_names.append(bids_name)
+        if len(new_names) == 0:
+            return 0
+
+        with open(self.edges_file, "ab") as fo:
+            # Drop rows left over by an append interrupted before its index update
+            fo.truncate(len(self) * self.n_edges * 4)
+            fo.write(np.vstack(rows).tobytes())
+        header = "" if op.exists(self.index_file) else "bids_name\n"
+        with open(self.index_file, "a") as fo:
+            fo.write(header + "".join(f"{x}\n" for x in new_names))
+        self.index.extend(new_names)
+        self._names.update(new_names)
+        return len(new_names)
+
+
+def fd_censoring(confounds, fd_thresh):
+    """Censoring vector with 0 for the volumes whose FD exceeds fd_thresh, 1 elsewhere.
+
+    confounds may also be an array of FD values with the volumes along the
+    last axis, e.g., (n_runs, n_volumes) to censor many runs in one call.
+    The first volume, without FD, is always kept.
+    """
+    if isinstance(confounds, np.ndarray):
+        fd = confounds
+    else:
+        fd = _as_confounds(confounds, groups=("fd",)).fd
+    fd_cens = np.ones(fd.shape)
+    with np.errstate(invalid="ignore"):
+        fd_cens[..., 1:][fd[..., 1:] > fd_thresh] = 0
     return fd_cens
 
 
 def enhance_censoring(censor_data, n_contig=2, n_before=1, n_after=2):
     """
     Censor non-contiguous TRs based on outlier file.
+
+    Flags n_before volumes before and n_after volumes after each censored
+    volume, then the unflagged gaps shorter than n_contig - 1 volumes between
+    flagged ones. Both steps are O(n_volumes) array operations (a windowed
+    count through a cumulative sum, and the previous/next flagged volume
+    through running max/min) along the last axis, so a 2D
+    (n_runs, n_volumes) censor array is processed as one batch.
     """
+    censored = np.asarray(censor_data).astype(int) != 1
+    n_vols = censored.shape[-1]
+    vols = np.arange(n_vols)
+
+    # Flag volumes within [-n_before, +n_after] of an outlier: count outliers
+    # in [vol - n_after, vol + n_before]
+    counts = np.concatenate(
+        (np.zeros(censored.shape[:-1] + (1,), int), np.cumsum(censored, axis=-1)), axis=-1
+    )
+    upper = np.minimum(vols + n_before, n_vols - 1) + 1
+    lower = np.maximum(vols - n_after, 0)
+    flagged = (counts[..., upper] - counts[..., lower]) > 0
+
+    # Flag orphan volumes (unflagged volumes between flagged ones less than
+    # n_contig volumes apart)
+    prev_flagged = np.maximum.accumulate(np.where(flagged, vols, -1), axis=-1)
+    next_flagged = np.flip(
+        np.minimum.accumulate(np.flip(np.where(flagged, vols, n_vols), axis=-1), axis=-1),
+        axis=-1,
+    )
+    orphans = (prev_flagged >= 0) & (next_flagged < n_vols)
+    orphans &= (next_flagged - prev_flagged) < n_contig
+    flagged |= orphans
 
-    censor_vec = 1 - censor_data.astype(int)
+    out_data = 1 - flagged.astype(int)
 
-    out_vec = np.zeros(censor_vec.shape, int)
-    cens_vols = np.where(censor_vec)[0]
+    return out_data
 
-    # Flag volumes before each outlier
-    temp = np.copy(cens_vols)
-    for trs_before in range(1, n_before + 1):
-        temp = np.hstack((temp, cens_vols - trs_before))
-    cens_vols = np.unique(temp)
-    all_vols = np.arange(len(censor_vec))
 
-    # Remove censored index outside range
-    # Unnecessary here but keeps everything interpretable
-    cens_vols = np.intersect1d(all_vols, cens_vols)
+def motion_parameters(confounds, derivatives=None):
+    confounds = _as_confounds(confounds, groups=("motion",))
+    motion_labels = MOTION_LABELS if derivatives else MOTION_LABELS[::2]
+    motion_regressors = pd.DataFrame(confounds.motion(derivatives), columns=motion_labels)
+    return motion_regressors
 
-    # Flag volumes after each outlier
-    temp = np.copy(cens_vols)
-    for trs_after in range(1, n_after + 1):
-        temp = np.hstack((temp, cens_vols + trs_after))
-    cens_vols = np.unique(temp)
-    all_vols = np.arange(len(censor_vec))
 
-    # Remove censored index outside range
-    cens_vols = np.intersect1d(all_vols, cens_vols)
+_roi_hashes = {}
 
-    # Flag orphan volumes (unflagged volumes between flagged ones)
-    temp = np.copy(cens_vols)
-    contig_idx = np.where(np.diff(cens_vols) < n_contig)[0]
-    for idx in contig_idx:
-        start = cens_vols[idx]
-        end = cens_vols[idx + 1]
-        temp = np.hstack((temp, np.arange(start, end)))
-    cens_vols = np.unique(temp)
 
-    # Create improved censor vector
-    out_vec[cens_vols] = 1
+def _sha1(in_file):
+    sha1 = hashlib.sha1()
+    with open(in_file, "rb") as fo:
+        for chunk in iter(lambda: fo.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
 
-    out_data = 1 - out_vec
 
-    return out_data
+def _file_hash(in_file):
+    """SHA-1 of a file's content, memoized per (path, mtime, size)."""
+    stat = os.stat(in_file)
+    key = (op.abspath(in_file), stat.st_mtime, stat.st_size)
+    if key not in _roi_hashes:
+        _roi_hashes[key] = _sha1(in_file)
+    return _roi_hashes[key]
 
 
-def motion_parameters(tmp_file, derivatives=None):
-    df_in = pd.read_csv(tmp_file, sep="\t")
-    if derivatives:
-        motion_labels = [
-            "trans_x",
-            "trans_x_derivative1",
-            "trans_y",
-            "trans_y_derivative1",
-            "trans_z",
-            "trans_z_derivative1",
-            "rot_x",
-            "rot_x_derivative1",
-            "rot_y",
-            "rot_y_derivative1",
-            "rot_z",
-            "rot_z_derivative1",
-        ]
+def _grid_hash(img):
+    grid = np.round(img.affine, 4).tobytes() + np.asarray(img.shape[:3], dtype=np.int64).tobytes()
+    return hashlib.sha1(grid).hexdigest()
+
+
+def grid_hash(nifti_file):
+    """Hash of the voxel grid (affine and 3D shape) of an image, from its header only."""
+    import nibabel as nib
+
+    return _grid_hash(nib.load(nifti_file))
+
+
+def cached_resample(roi_in, template, cache_dir):
+    """Path of roi_in resampled to the grid of template, in the content-addressed cache_dir.
+
+    The file is named by the hash of roi_in plus the target affine and shape,
+    and made with 3dresample the first time only. roi_in is never modified.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_file = op.join(
+        cache_dir, f"{_file_hash(roi_in)[:16]}_grid-{grid_hash(template)[:16]}.nii.gz"
+    )
+    if not op.exists(cache_file):
+        tmp_file = cache_file.replace(
+            ".nii.gz", f"_{socket.gethostname()}-{os.getpid()}.tmp.nii.gz"
+        )
+        roi_resample(roi_in, tmp_file, template)
+        os.replace(tmp_file, cache_file)
+    return cache_file
+
+
+def roi_resample(roi_in, roi_out, template, cache_dir=None):
+    """Resample roi_in to the grid of template with 3dresample.
+
+    With cache_dir, the resampled image is content-addressed by the hash of
+    roi_in plus the target affine and shape, so every run on the same grid
+    shares one 3dresample call; roi_out is then a hardlink to the cached file
+    (or a copy when the cache is on another filesystem).
+    """
+    if cache_dir is None:
+        run_tool(["3dresample", "-prefix", roi_out, "-master", template, "-inset", roi_in])
+        return
+
+    cache_file = cached_resample(roi_in, template, cache_dir)
+    if op.exists(roi_out):
+        os.remove(roi_out)
+    try:
+        os.link(cache_file, roi_out)
+    except OSError:
+        copyfile(cache_file, roi_out)
+
+
+_tool_versions = {}
+
+
+def tool_versions(tools=("afni",)):
+    """Versions of the command-line tools and Python packages used by a step."""
+    import nibabel as nib
+
+    for tool in tools:
+        if tool not in _tool_versions:
+            if tool == "afni":
+                _tool_versions[tool] = run_command("afni -ver")
+            elif tool == "fsl":
+                _tool_versions[tool] = run_command("cat ${FSLDIR}/etc/fslversion")
+            else:
+                _tool_versions[tool] = run_command(f"{tool} --version")
+    versions = {tool: _tool_versions[tool] for tool in tools}
+    versions.update({"numpy": np.__version__, "nibabel": nib.__version__})
+    return versions
+
+
+class Workflow:
+    """Make-like executor that only reruns the steps whose outputs are stale.
+
+    Each step (node) declares its input files, output files and parameters.
+    The manifest (a JSON file) records, per node, the content hash of every
+    input, the parameters and the tool versions that produced its outputs. A
+    node is stale when an output is missing or when any of these changed, so
+    editing ``fd_thresh`` or recomputing an upstream file invalidates every
+    downstream node, and dependencies follow from the files nodes share.
+    Outputs are written under a temporary directory next to the final files
+    and renamed into place only once the node has finished, so a killed job
+    never leaves a partial output that looks complete.
+
+    File hashes are cached in the manifest by (size, mtime), so unchanged
+    files are only read once. Files larger than hash_max_size (e.g., BOLD
+    runs) are not read at all: their (size, mtime) is their fingerprint, so
+    touching them reruns their nodes. Inputs removed after use (intermediate
+    files) keep their last recorded hash.
+
+    The manifest is merged with the file on disk and rewritten, under an
+    ``fcntl`` lock, once every save_every committed nodes. Workflows with
+    many nodes (e.g., one per subject) should raise save_every and call
+    ``save`` once done; nodes committed but not saved are just rerun.
+
+    Parameters
+    ----------
+    manifest_file : str
+        Path to the JSON manifest.
+    tool_versions : dict, optional
+        Versions of the tools used by the nodes, see ``tool_versions``.
+    save_every : int, optional
+        Committed nodes between two saves of the manifest. Default: 1.
+    hash_max_size : int, optional
+        Size in bytes above which files are fingerprinted by size and mtime.
+
+    Examples
+    --------
+    >>> node = workflow.node("regressors", [confounds_file], [regressor_file], {"dummy": 4})
+    >>> if node.stale:
+    ...     np.savetxt(node.tmp(regressor_file), regressors)
+    ...     node.commit()
+    """
+
+    def __init__(self, manifest_file, tool_versions=None, save_every=1, hash_max_size=1 << 26):
+        self.manifest_file = manifest_file
+        self.tool_versions = tool_versions or {}
+        self.save_every = save_every
+        self.hash_max_size = hash_max_size
+        self._manifest = None
+        self._new_files = {}
+        self._new_nodes = {}
+
+    def _read(self):
+        if op.exists(self.manifest_file):
+            with open(self.manifest_file, "r") as fo:
+                return js.load(fo)
+        return {"files": {}, "nodes": {}}
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            self._manifest = self._read()
+        return self._manifest
+
+    def file_hash(self, in_file):
+        """SHA-1 of a file (or size and mtime of a large one), cached by size and mtime."""
+        record = self.manifest["files"].get(in_file)
+        if not op.exists(in_file):
+            return None if record is None else record["sha1"]
+        stat = os.stat(in_file)
+        if (
+            (record is None)
+            or (record["sha1"] is None)
+            or (record["size"] != stat.st_size)
+            or (record["mtime"] != stat.st_mtime_ns)
+        ):
+            if stat.st_size > self.hash_max_size:
+                file_hash = f"size-{stat.st_size}_mtime-{stat.st_mtime_ns}"
+            else:
+                file_hash = _sha1(in_file)
+            record = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "sha1": file_hash}
+            self.manifest["files"][in_file] = record
+            self._new_files[in_file] = record
+        return record["sha1"]
+
+    def node(self, name, inputs, outputs, params=None):
+        """Declare a node; check ``node.stale`` before running it."""
+        return WorkflowNode(self, name, inputs, outputs, params)
+
+    def _record(self, name, record, out_files):
+        for out_file in out_files:
+            stat = os.stat(out_file)
+            file_record = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "sha1": None}
+            self.manifest["files"][out_file] = file_record
+            self._new_files[out_file] = file_record
+        self.manifest["nodes"][name] = record
+        self._new_nodes[name] = record
+        if len(self._new_nodes) >= self.save_every:
+            self.save()
+
+    def save(self):
+        """Merge the nodes and file hashes recorded since the last save into the manifest."""
+        if not (self._new_nodes or self._new_files):
+            return
+        os.makedirs(op.dirname(op.abspath(self.manifest_file)), exist_ok=True)
+        lock_fd = os.open(f"{self.manifest_file}.lock", os.O_RDWR | os.O_CREAT, 0o664)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            # Merge with the manifest on disk, in case another process updated it
+            manifest = self._read()
+            manifest["files"].update(self._new_files)
+            manifest["nodes"].update(self._new_nodes)
+            tmp_file = f"{self.manifest_file}.{socket.gethostname()}_{os.getpid()}.tmp"
+            with open(tmp_file, "w") as fo:
+                js.dump(manifest, fo, sort_keys=True, indent=4)
+            os.replace(tmp_file, self.manifest_file)
+        finally:
+            os.close(lock_fd)
+        self._manifest = manifest
+        self._new_files = {}
+        self._new_nodes = {}
+
+
+class WorkflowNode:
+    """One step of a ``Workflow``, with its staleness and temporary outputs."""
+
+    def __init__(self, workflow, name, inputs, outputs, params=None):
+        self.workflow = workflow
+        self.name = name
+        self.outputs = list(outputs)
+        manifest_name = op.splitext(op.basename(workflow.manifest_file))[0]
+        self.tmp_dir = op.join(
+            op.dirname(self.outputs[0]),
+            f".{manifest_name}_{name}_{socket.gethostname()}_{os.getpid()}.tmp",
+        )
+        signature = {
+            "inputs": {in_file: workflow.file_hash(in_file) for in_file in inputs},
+            "params": params or {},
+            "tools": workflow.tool_versions,
+        }
+        # Normalize numpy and tuple values to their JSON form before comparing
+        self.signature = js.loads(js.dumps(signature, sort_keys=True, default=str))
+        record = workflow.manifest["nodes"].get(name)
+        self.stale = (
+            (record is None)
+            or (record["signature"] != self.signature)
+            or (not all(op.exists(out_file) for out_file in self.outputs))
+        )
+        # Leftovers of a failed attempt by a process with the same pid
+        self.discard()
+
+    def tmp(self, out_file):
+        """Temporary path to write out_file (or any scratch file) to."""
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        return op.join(self.tmp_dir, op.basename(out_file))
+
+    def commit(self, move_all=False):
+        """Rename the outputs into place and record the node in the manifest.
+
+        With move_all, every other file written to the temporary directory is
+        also moved next to the outputs; otherwise scratch files are removed.
+        """
+        for out_file in self.outputs:
+            os.replace(self.tmp(out_file), out_file)
+        if move_all:
+            out_dir = op.dirname(self.outputs[0])
+            for tmp_name in os.listdir(self.tmp_dir):
+                os.replace(op.join(self.tmp_dir, tmp_name), op.join(out_dir, tmp_name))
+        self.discard()
+        self.workflow._record(
+            self.name, {"signature": self.signature, "outputs": self.outputs}, self.outputs
+        )
+        self.stale = False
+
+    def discard(self):
+        """Remove the temporary directory."""
+        if op.isdir(self.tmp_dir):
+            rmtree(self.tmp_dir)
+
+
+def get_kept_volumes(clean_subj_dir, prefix, fd_thresh=None):
+    """Indices of the volumes of a denoised run that survived censoring.
+
+    Read from the ``KeptVolumes`` field of the denoised JSON sidecar written by
+    ``denoising.py``. Runs denoised before that field existed fall back to
+    parsing the ``*_censoring*.1D`` file.
+    """
+    json_files = sorted(glob(op.join(clean_subj_dir, f"{prefix}_desc-*_bold.json")))
+    for json_file in json_files:
+        with open(json_file) as fo:
+            json_info = js.load(fo)
+        if ("KeptVolumes" in json_info) and (
+            (fd_thresh is None) or (json_info.get("CensoringThreshold") == fd_thresh)
+        ):
+            return np.array(json_info["KeptVolumes"], dtype=int)
+
+    censor_thresh = "*" if fd_thresh is None else fd_thresh
+    censor_files = glob(op.join(clean_subj_dir, f"{prefix}_censoring{censor_thresh}.1D"))
+    assert len(censor_files) == 1
+    return np.where(np.loadtxt(censor_files[0], ndmin=1) == 1)[0]
+
+
+THREAD_ENV_VARS = [
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+]
+
+
+def set_threads(n_threads):
+    """Limit the threads of the AFNI/FSL children and of NumPy's BLAS in this process.
+
+    The variables are set in os.environ, which every os.system/subprocess child
+    inherits (``os.system("export OMP_NUM_THREADS=...")`` only affected a
+    throwaway shell). BLAS pools already started by NumPy are resized with
+    threadpoolctl, when it is installed.
+    """
+    n_threads = int(n_threads)
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(n_threads)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(n_threads)
+
+
+def split_cores(n_jobs, n_tasks):
+    """Split n_jobs CPUs into (concurrent tasks, threads per task)."""
+    n_workers = max(1, min(int(n_jobs), n_tasks))
+    return n_workers, max(1, int(n_jobs) // n_workers)
+
+
+class StageTimer:
+    """Accumulate the wall time of named stages.
+
+    Examples
+    --------
+    >>> timer = StageTimer()
+    >>> with timer("nuisance_reg"):
+    ...     nuisance_reg(...)
+    >>> print(timer.report())
+    """
+
+    def __init__(self):
+        self.timings = {}
+
+    @contextmanager
+    def __call__(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage] = self.timings.get(stage, 0) + time.perf_counter() - start
+
+    def report(self):
+        return ", ".join(f"{stage}: {elapsed:.1f}s" for stage, elapsed in self.timings.items())
+
+
+# Dummy scans of the ABCD rs-fMRI sequence per scanner manufacturer
+DUMMY_SCANS = {"GE": 5, "Siemens": 8, "Philips": 8}
+
+
+def manufacturer_dummy_scans(manufacturer):
+    """Dummy scans for a Manufacturer value, e.g. "GE MEDICAL SYSTEMS" or "Siemens"."""
+    if isinstance(manufacturer, str):
+        for name, n_dummy in DUMMY_SCANS.items():
+            if name.lower() in manufacturer.lower():
+                return n_dummy
+    return None
+
+
+def raw_sidecar(nifti_file, bids_dir):
+    """Sidecar JSON of the raw BIDS run an image (raw or derivative) comes from, if any."""
+    entities = [
+        x
+        for x in op.basename(nifti_file).split("_")[:-1]
+        if not x.startswith(("space-", "desc-", "res-"))
+    ]
+    session = next((x for x in entities if x.startswith("ses-")), "")
+    run_base = "_".join(entities)
+    # The raw ABCD runs are zero-padded (run-01) while fMRIPrep drops the padding (run-1)
+    for base in (run_base, run_base.replace("run-", "run-0")):
+        json_file = op.join(bids_dir, entities[0], session, "func", f"{base}_bold.json")
+        if op.exists(json_file):
+            return json_file
+    return None
+
+
+def run_key(nifti_file):
+    """Path of an image relative to the root of its tree, e.g. sub-01/ses-1/func/<name>.
+
+    The root is the parent of the image's last sub-* directory, so the key is
+    the same on the host and in containers binding the tree elsewhere.
+    """
+    parts = op.normpath(op.abspath(nifti_file)).split(os.sep)
+    subject_dirs = [i for i, x in enumerate(parts[:-1]) if x.startswith("sub-")]
+    return "/".join(parts[subject_dirs[-1] :] if subject_dirs else parts[-1:])
+
+
+def _read_run(nifti_file, bids_dir=None, manufacturers=None):
+    """Index row of one image, from its header and its raw sidecar."""
+    import nibabel as nib
+
+    img = nib.load(nifti_file)
+    shape = img.header.get_data_shape()
+    zooms = img.header.get_zooms()
+    manufacturer = None
+    json_file = raw_sidecar(nifti_file, bids_dir) if bids_dir else None
+    if json_file is not None:
+        with open(json_file) as fo:
+            manufacturer = js.load(fo).get("Manufacturer")
+    if manufacturer is None and manufacturers is not None:
+        manufacturer = manufacturers.get(op.basename(nifti_file).split("_")[0])
+    stat = os.stat(nifti_file)
+    return {
+        "key": run_key(nifti_file),
+        "path": nifti_file,
+        "nvol": int(np.prod(shape[3:])),
+        "shape": ",".join(str(x) for x in shape[:3]),
+        "grid": _grid_hash(img),
+        "t_r": float(zooms[3]) if len(zooms) > 3 else np.nan,
+        "manufacturer": manufacturer,
+        "dummy_scans": manufacturer_dummy_scans(manufacturer),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+    }
+
+
+class RunIndex:
+    """Dataset-level table of run metadata, read once from the image headers and sidecars.
+
+    One row per image, keyed by its path within its tree (see run_key) so
+    that the same index serves the host and the containers (where the trees
+    are bound at other paths), with columns path, nvol, shape (3D voxel grid),
+    grid (see grid_hash), t_r, manufacturer, dummy_scans, size and mtime.
+    Images of different trees with the same key (e.g., the brain masks copied
+    from fMRIPrep with their mtime by denoising.py and rsfc.py) share a row,
+    which holds for every copy of the same size and mtime. ``update`` only
+    reads the images that are new or changed since (by size and mtime), with
+    a pool of threads. The queries read the header themselves when an image
+    is missing from the index or differs from its row, so a stale index is
+    slow but never wrong.
+
+    Examples
+    --------
+    >>> run_index = RunIndex("dset/derivatives/run_index.tsv")
+    >>> run_index.update(bold_files, bids_dir="dset", n_jobs=8)
+    >>> run_index.nvol(preproc_file)
+    """
+
+    columns = [
+        "path",
+        "nvol",
+        "shape",
+        "grid",
+        "t_r",
+        "manufacturer",
+        "dummy_scans",
+        "size",
+        "mtime",
+    ]
+    _loaded = {}
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self.df = pd.DataFrame(columns=self.columns, index=pd.Index([], name="key"))
+        if op.exists(index_file):
+            df = pd.read_csv(index_file, sep="\t", dtype={"dummy_scans": "Int64"})
+            # Indexes keyed by file name only are rebuilt
+            if "key" in df.columns:
+                self.df = df.set_index("key")
+
+    @classmethod
+    def load(cls, run_index):
+        """RunIndex of an index file, read once per process; RunIndex objects pass through."""
+        if isinstance(run_index, cls):
+            return run_index
+        if run_index not in cls._loaded:
+            cls._loaded[run_index] = cls(run_index)
+        return cls._loaded[run_index]
+
+    def __len__(self):
+        return len(self.df)
+
+    def update(self, nifti_files, bids_dir=None, participants_file=None, n_jobs=1):
+        """Index the new or changed images of nifti_files and save the index.
+
+        The manufacturer comes from the raw sidecar in bids_dir, or else from
+        the Manufacturer column of participants_file. Returns the number of
+        images read.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        manufacturers = None
+        if participants_file is not None:
+            participants_df = pd.read_csv(
+                participants_file, sep="\t", usecols=["participant_id", "Manufacturer"]
+            )
+            manufacturers = participants_df.set_index("participant_id")["Manufacturer"].to_dict()
+
+        # Images of several trees may share a key: a key is read once, from its first image,
+        # and only if none of its images matches its row
+        keys = [run_key(x) for x in nifti_files]
+        current_keys = {key for key, x in zip(keys, nifti_files) if self._current(key, x)}
+        to_read = {}
+        for key, nifti_file in zip(keys, nifti_files):
+            if key not in current_keys:
+                to_read.setdefault(key, nifti_file)
+        to_read = list(to_read.values())
+        n_shared = len(nifti_files) - len(set(keys))
+        print(
+            f"Reading {len(to_read)}/{len(nifti_files)} image headers "
+            f"({n_shared} images share the key of another image)",
+            flush=True,
+        )
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            rows = list(executor.map(lambda x: _read_run(x, bids_dir, manufacturers), to_read))
+        if len(rows) > 0:
+            new_df = pd.DataFrame(rows).set_index("key")
+            self.df = pd.concat([self.df.drop(new_df.index, errors="ignore"), new_df])
+            self.df["dummy_scans"] = self.df["dummy_scans"].astype("Int64")
+            self.save()
+        return len(rows)
+
+    def save(self):
+        tmp_file = f"{self.index_file}.{socket.gethostname()}_{os.getpid()}.tmp"
+        os.makedirs(op.dirname(op.abspath(self.index_file)), exist_ok=True)
+        self.df.sort_index().to_csv(tmp_file, sep="\t")
+        os.replace(tmp_file, self.index_file)
+
+    def _current(self, key, nifti_file):
+        """Whether the row of key describes nifti_file (same size and mtime)."""
+        if key not in self.df.index:
+            return False
+        stat = os.stat(nifti_file)
+        return (self.df.at[key, "size"] == stat.st_size) and (
+            self.df.at[key, "mtime"] == stat.st_mtime_ns
+        )
+
+    def row(self, nifti_file):
+        """Index row of an image, read from its header if missing or changed since."""
+        key = run_key(nifti_file)
+        if self._current(key, nifti_file):
+            return self.df.loc[key]
+        row = _read_run(nifti_file)
+        if key in self.df.index:
+            # Keep the indexed manufacturer, which needs the raw dataset to be read again
+            row["manufacturer"] = self.df.at[key, "manufacturer"]
+            row["dummy_scans"] = self.df.at[key, "dummy_scans"]
+        return pd.Series(row)
+
+    def nvol(self, nifti_file):
+        return int(self.row(nifti_file)["nvol"])
+
+    def shape(self, nifti_file):
+        """3D shape of the voxel grid."""
+        return tuple(int(x) for x in self.row(nifti_file)["shape"].split(","))
+
+    def grid(self, nifti_file):
+        return self.row(nifti_file)["grid"]
+
+    def dummy_scans(self, nifti_file, default=None):
+        dummy_scans = self.row(nifti_file)["dummy_scans"]
+        return default if pd.isna(dummy_scans) else int(dummy_scans)
+
+
+def read_table(table_file, columns=None, index_col=None, sep="\t", cache_dir=None):
+    """Read the given columns of a CSV/TSV table through a typed Parquet copy.
+
+    The table is parsed once into ``<cache_dir>/<name>.parquet`` (next to the
+    table by default), which carries the table's mtime and is rewritten when
+    the table changes. Later reads only load the requested columns, memory
+    mapped. Columns mixing strings with other values are stored as strings.
+    Without pyarrow, the table itself is read.
+    """
+    usecols = None if columns is None else list(columns)
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        print(f"Reading {table_file} without a Parquet copy: pyarrow is not installed", flush=True)
+        table_df = pd.read_csv(table_file, sep=sep, usecols=usecols, low_memory=False)
     else:
-        motion_labels = ["trans_x", "trans_y", "trans_z", "rot_x", "rot_y", "rot_z"]
-    motion_regressors = df_in[motion_labels]
-    return motion_regressors
+        if cache_dir is None:
+            cache_dir = op.dirname(op.abspath(table_file))
+        cache_file = op.join(cache_dir, f"{op.basename(table_file)}.parquet")
+        table_mtime = os.stat(table_file).st_mtime_ns
+        if not op.exists(cache_file) or os.stat(cache_file).st_mtime_ns != table_mtime:
+            print(f"Caching {table_file} to {cache_file}", flush=True)
+            table_df = pd.read_csv(table_file, sep=sep, low_memory=False)
+            # Parquet needs one type per column
+            for column in table_df.columns[table_df.dtypes == object]:
+                values = table_df[column]
+                table_df[column] = values.where(values.isna(), values.astype(str))
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_file = f"{cache_file}.{socket.gethostname()}_{os.getpid()}.tmp"
+            try:
+                table_df.to_parquet(tmp_file, index=False)
+                os.utime(tmp_file, ns=(table_mtime, table_mtime))
+                os.replace(tmp_file, cache_file)
+            finally:
+                if op.exists(tmp_file):
+                    os.remove(tmp_file)
+        table_df = pd.read_parquet(cache_file, columns=usecols, memory_map=True)
+
+    if index_col is not None:
+        table_df = table_df.set_index(index_col)
+    return table_df
+
+
+def select_subjects(subjects=None, participants_file=None, start=None, stop=None):
+    """Subjects given on the command line, or the [start, stop) rows of participants.tsv."""
+    if subjects:
+        return subjects
+    participants_df = pd.read_csv(participants_file, sep="\t", usecols=["participant_id"])
+    return participants_df["participant_id"].iloc[start:stop].tolist()
+
 
+def run_subjects(func, subjects, n_workers=1, **kwargs):
+    """Call func(subject=subject, **kwargs) for every subject with a pool of n_workers.
 
-def get_nvol(nifti_file):
+    A failing subject does not stop the others; the subjects that failed are
+    reported and returned.
+    """
+    failed = []
+    if n_workers == 1:
+        for subject in subjects:
+            try:
+                func(subject=subject, **kwargs)
+            except Exception as exc:
+                print(f"{subject} failed: {exc!r}", flush=True)
+                failed.append(subject)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = {
+                subject: executor.submit(func, subject=subject, **kwargs) for subject in subjects
+            }
+            for subject, future in futures.items():
+                try:
+                    future.result()
+                except Exception as exc:
+                    print(f"{subject} failed: {exc!r}", flush=True)
+                    failed.append(subject)
+    print(f"Processed {len(subjects) - len(failed)}/{len(subjects)} subjects", flush=True)
+    return failed
+
+
+def get_nvol(nifti_file, run_index=None):
     import nibabel as nib
 
+    if run_index is not None:
+        return RunIndex.load(run_index).nvol(nifti_file)
+
     # Looking for nvol in the nifti header
     img = nib.load(nifti_file)
     header = img.header
@@ -143,9 +1250,8 @@ def get_nvol(nifti_file):
 
 def keep_trs(confounds_file, qc_thresh):
     print("\tGet TRs to censor")
-    confounds_df = pd.read_csv(confounds_file, sep="\t")
-    qc_arr = confounds_df["framewise_displacement"].values
-    qc_arr = np.nan_to_num(qc_arr, 0)
+    qc_arr = _as_confounds(confounds_file, groups=("fd",)).fd
+    qc_arr = np.nan_to_num(qc_arr, copy=True)
     threshold = 3
 
     mask = qc_arr >= qc_thresh